@@ -1,9 +1,15 @@
 import random
-from operator import attrgetter
+import numpy as np
+
+# Fish sizes, as a percentage of the species' maximum: normally
+# distributed, clamped to SIZE_MIN..SIZE_MAX
+SIZE_MU = 50
+SIZE_SIGMA = 13
+SIZE_MIN = 5
+SIZE_MAX = 100
 
 class Location:
-    def __init__(self, db, id, name, drop_table):
-        self.db = db
+    def __init__(self, id, name, drop_table):
         self.id = id
         self.name = name
         self.drop_table = drop_table
@@ -11,30 +17,67 @@ class Location:
     @property
     def species(self):
         return self.drop_table.drops
-    
-    @property
-    def catches(self):
-        # Return list of catches from this location
-        # Sorted by fish length. Longest -> Shortest
-        c = []
-        for id,catch in self.db.fish_catches.items():
-            if catch.location_id == self.id:
-                c.append(catch)
-        return sorted(c, key=attrgetter('length_in'), reverse=True)
 
 class DropTable:
+    # Weighted choice of species, by Vose's alias method: the table is built
+    # once, then each draw is one uniform pick of a column plus one coin
+    # flip between the column's species and its alias, whatever the number
+    # of species.
+
     def __init__(self, drops, weights):
-        self.drops   = drops
-        self.weights = weights
+        self.drops   = tuple(drops)
+        self.weights = tuple(weights)
+
+        n = len(self.weights)
+        total = sum(self.weights)
+        scaled = [w * n / total for w in self.weights]
+        self.probability = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # Whatever is left is 1 up to rounding
+
+        # The same tables, and the species' stats, as arrays for get_drops()
+        self.probability_array = np.array(self.probability)
+        self.alias_array = np.array(self.alias)
+        self.max_weight_lbs = np.array([s.max_weight_lbs for s in self.drops], dtype=float)
+        self.max_length_in = np.array([s.max_length_in for s in self.drops], dtype=float)
+        self.value_lbc = np.array([s.value_lbc for s in self.drops])
 
     def get_drop(self):
-        species = random.choices(self.drops, self.weights)[0]
-        return Fish(species)
+        i = random.randrange(len(self.drops))
+        if random.random() >= self.probability[i]:
+            i = self.alias[i]
+        return Fish(self.drops[i])
+
+    def get_drops(self, n, rng=None):
+        # n catches at once, for simulations and tests. Returns
+        # (species, relative_size): species are indexes into self.drops and
+        # sizes are as in Fish.relative_size. Pass a numpy Generator, e.g.
+        # np.random.default_rng(seed), for repeatable draws.
+        rng = rng or np.random.default_rng()
+        species = self.get_species(n, rng)
+        sizes = np.clip(rng.normal(SIZE_MU, SIZE_SIGMA, n), SIZE_MIN, SIZE_MAX) / 100
+        return species, sizes
+
+    def get_species(self, n, rng=None):
+        # Just the species of n catches, as in get_drops()
+        rng = rng or np.random.default_rng()
+        column = rng.integers(len(self.drops), size=n)
+        flip = rng.random(n)
+        return np.where(flip < self.probability_array[column], column, self.alias_array[column])
 
 class Fish:
-    def __init__(self, species):
+    def __init__(self, species, relative_size=None):
         self.species = species
-        self.relative_size = self._relative_size()
+        self.relative_size = self._relative_size() if relative_size is None else relative_size
         self.weight_lbs = self._weight()
         self.length_in = self._length()
 
@@ -42,15 +85,10 @@ class Fish:
         # This property represents the "size" of the
         # fish relative to its maximum possible size.
         w = random.gauss(
-            mu = 50,
-            sigma = 13
+            mu = SIZE_MU,
+            sigma = SIZE_SIGMA
         )
-        if w > 100:
-            return 100
-        elif w < 5:
-            return 5
-        else:
-            return w / 100
+        return min(max(w, SIZE_MIN), SIZE_MAX) / 100
 
     def _weight(self):
         return self.relative_size * self.species.max_weight_lbs
@@ -316,129 +354,124 @@ humphead_wrasse = FishSpecies(
     value_lbc = 6
 )
 
-class Fishing:
-    def __init__(self, db):
-        self.db = db
-
-        # Add locations to activity!
-        self.tributary_river = Location(
-            db,
-            id='tributary_river',
-            name='Tributary River',
-            drop_table=DropTable(
-                drops = [
-                    salmon_pink, 
-                    salmon_coho, 
-                    salmon_sockeye, 
-                    salmon_chinook
-                ],
-                weights = [
-                    50, # Common
-                    30, # Uncommon
-                    15, # Rare
-                    5   # Epic
-                ]
-            )
-        )
+# Locations
+
+tributary_river = Location(
+    id='tributary_river',
+    name='Tributary River',
+    drop_table=DropTable(
+        drops = [
+            salmon_pink, 
+            salmon_coho, 
+            salmon_sockeye, 
+            salmon_chinook
+        ],
+        weights = [
+            50, # Common
+            30, # Uncommon
+            15, # Rare
+            5   # Epic
+        ]
+    )
+)
 
-        self.open_ocean = Location(
-            db,
-            id='open_ocean',
-            name='Open Ocean',
-            drop_table=DropTable(
-                drops = [
-                    arctic_grayling, 
-                    arctic_cod, 
-                    alaska_rockfish, 
-                    pacific_halibut,
-                    bluefin_tuna,
-                    swordfish
-                ],
-                weights = [
-                    30, # Uncommon
-                    30, # Uncommon
-                    15, # Rare
-                    15, # Rare
-                    5,  # Epic
-                    1   # Epic
-                ]
-            )
-        )
+open_ocean = Location(
+    id='open_ocean',
+    name='Open Ocean',
+    drop_table=DropTable(
+        drops = [
+            arctic_grayling, 
+            arctic_cod, 
+            alaska_rockfish, 
+            pacific_halibut,
+            bluefin_tuna,
+            swordfish
+        ],
+        weights = [
+            30, # Uncommon
+            30, # Uncommon
+            15, # Rare
+            15, # Rare
+            5,  # Epic
+            1   # Epic
+        ]
+    )
+)
 
-        self.estuary = Location(
-            db,
-            id='estuary',
-            name='Estuary',
-            drop_table=DropTable(
-                drops = [
-                    scup, 
-                    menhaden, 
-                    striped_bass, 
-                    black_sea_bass, 
-                    bonito, 
-                    bluefish
-                ],
-                weights = [
-                    25, # Uncommon
-                    25, # Uncommon
-                    15, # Rare
-                    15, # Rare
-                    15, # Rare
-                    1   # Epic
-                ]
-            )
-        )
+estuary = Location(
+    id='estuary',
+    name='Estuary',
+    drop_table=DropTable(
+        drops = [
+            scup, 
+            menhaden, 
+            striped_bass, 
+            black_sea_bass, 
+            bonito, 
+            bluefish
+        ],
+        weights = [
+            25, # Uncommon
+            25, # Uncommon
+            15, # Rare
+            15, # Rare
+            15, # Rare
+            1   # Epic
+        ]
+    )
+)
 
-        self.coral_reef = Location(
-            db,
-            id='coral_reef',
-            name='Coral Reef',
-            drop_table=DropTable(
-                drops = [
-                    sergeant_major,
-                    yellowtail_snapper,
-                    spanish_mackerel,
-                    goatfish,
-                    parrotfish,
-                    hogfish,
-                    mahi_mahi,
-                    red_grouper,
-                    trevally,
-                    humphead_wrasse
-                ],
-                weights = [
-                    20,
-                    20,
-                    15, 
-                    15, 
-                    10, 
-                    10,
-                    4, 
-                    3,
-                    2, 
-                    1
-                ]
-            )
-        )
+coral_reef = Location(
+    id='coral_reef',
+    name='Coral Reef',
+    drop_table=DropTable(
+        drops = [
+            sergeant_major,
+            yellowtail_snapper,
+            spanish_mackerel,
+            goatfish,
+            parrotfish,
+            hogfish,
+            mahi_mahi,
+            red_grouper,
+            trevally,
+            humphead_wrasse
+        ],
+        weights = [
+            20,
+            20,
+            15, 
+            15, 
+            10, 
+            10,
+            4, 
+            3,
+            2, 
+            1
+        ]
+    )
+)
+
+class Fishing:
+    # The fishing game: every location and species. Built once, as FISHING
+    # below, and shared by every request. Nothing here changes after import.
+
+    def __init__(self, locations):
+        self.locations = tuple(locations)
+        self.location_ids = {location.id: location for location in self.locations}
+        self.species = {}
+        for location in self.locations:
+            for species in location.species:
+                # Every species lives in exactly one location
+                species.location = location
+                self.species[species.id] = species
 
     @property
     def fishing_attempts_allowed(self):
         return len(self.locations)
 
-    @property
-    def locations(self):
-        l = []
-        for id,object in vars(self).items():
-            if isinstance(object, Location):
-                l.append(object)
-        return l
-
-    @property
-    def species(self):
-        s = {}
-        for location in self.locations:
-            for species in location.species:
-                s[species.id] = species
-                setattr(s[species.id], 'location', location)
+    def location(self, id):
+        # The location with this id, or None
+        return self.location_ids.get(id)
 
-        return s
+FISHING = Fishing([tributary_river, open_ocean, estuary, coral_reef])
@@ -1,19 +1,46 @@
-from flask import Flask, render_template, request, redirect, make_response
+from flask import Flask, render_template, request, redirect, make_response, jsonify, abort
 from flask_bcrypt import Bcrypt
 
+import os
+import atexit
+import functools
 import datetime
 import pytz
 from urllib.parse import urlparse
 import requests
 
-from db import Database, hash_img
-db = Database('db.xlsx')
-
-from activities.fishing import Fishing
+from db import Database, TransactionError, hash_img
+db = Database(
+    os.environ.get('LBC_DB', 'db.xlsx'),
+    durability=os.environ.get('LBC_DURABILITY', 'sync')
+)
+# python app.py runs with the reloader, which imports this module in a
+# watcher process as well as in the one that serves. Only the server
+# checkpoints: the watcher never sees its writes, so it would fold them
+# into the workbook and then snapshot tables that are missing them.
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN'):
+    atexit.register(db.checkpoint)
+
+from activities.fishing import FISHING
+from cache import ResponseCache
 
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
 
+# Rows per page of the ledger and other long listings
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Public pages render the same for every visitor until the next write
+page_cache = ResponseCache()
+
+def cached(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.path, request.query_string)
+        return page_cache.get(key, db.generation, lambda: view(*args, **kwargs))
+    return wrapper
+
 @app.route("/")
 def home():
     user = authentication_check(request)
@@ -33,10 +60,10 @@ def wallet():
     user = authentication_check(request)
     if not user:
         return redirect("login")
-    tokens = list(user.tokens.values())
     return render_template(
         "wallet.html",
-        tokens=tokens,
+        tokens=user.token_page(limit=6),
+        transactions=user.transaction_page(limit=10)['transactions'],
         user=user
     )
 
@@ -90,16 +117,28 @@ def change_password():
 
 
 @app.route("/leaderboard")
+@cached
 def leaderboard():
-    users = list(db.users.values())
-    users = users[1:]
-    users = sorted(users, key=lambda x: x.balance, reverse=True)
+    by, page, pages = leaderboard_args(request)
     return render_template(
         "leaderboard.html", 
-        users=users
+        users=db.leaderboard(by, (page - 1) * PAGE_SIZE, PAGE_SIZE),
+        by=by,
+        page=page,
+        pages=pages
     )
 
+def leaderboard_args(request):
+    # Ranking and page from ?by= and ?page=
+    by = request.args.get('by', 'balance')
+    if by not in db.rankings:
+        by = 'balance'
+    pages = max(-(-db.rankings[by].ranked() // PAGE_SIZE), 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    return by, page, pages
+
 @app.route("/market")
+@cached
 def market():
     for_sale = list(db.for_sale().values())
     for_sale.reverse()
@@ -109,29 +148,39 @@ def market():
     )
 
 @app.route("/user/<username>")
+@cached
 def user(username):
     user = db.get_user(username)
-    tokens = list(user.tokens.values())
     return render_template(
         "user.html", 
         user=user,
-        tokens=tokens
+        tokens=user.token_page(limit=6),
+        transactions=user.transaction_page(limit=10)['transactions']
     )
 
 @app.route("/user/<username>/transactions")
 def user_transactions(username):
     user = db.get_user(username)
+    page = user.transaction_page(**page_args(request))
     return render_template(
         "user_transactions.html",
-        user=user
+        user=user,
+        transactions=page['transactions'],
+        newer=page['newer'],
+        older=page['older']
     )
 
 @app.route("/user/<username>/tokens")
 def user_tokens(username):
     user = db.get_user(username)
+    pages = max(-(-user.token_count // PAGE_SIZE), 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
     return render_template(
         "user_tokens.html",
-        user=user
+        user=user,
+        tokens=user.token_page(page, PAGE_SIZE),
+        page=page,
+        pages=pages
     )
 
 @app.route("/token/<token_id>")
@@ -271,11 +320,11 @@ def logout():
     return redirect("/")
 
 @app.route("/fishing")
+@cached
 def fishing():
-    fishing = Fishing(db)
     return render_template(
         "fishing.html",
-        fishing=fishing
+        fishing=FISHING
     )
 
 @app.route("/fishing/<location>")
@@ -285,18 +334,21 @@ def fishing_location(location):
     if not user:
         return redirect("/login")
 
-    fishing = Fishing(db)
+    location = FISHING.location(location)
 
     # If requested location doesn't exist
-    if not hasattr(fishing, location):
+    if not location:
         return render_template(
-            "fishing.html"
+            "fishing.html",
+            fishing=FISHING
         )
 
     # Otherwise render the location!
     return render_template(
         "fishing_location.html",
-        location=getattr(fishing, location),
+        location=location,
+        catches=db.record_catches('length', location_id=location.id),
+        catch_count=db.catch_count(location.id),
         user=user
     )
 
@@ -307,17 +359,17 @@ def fishing_species(species):
     if not user:
         return redirect("/login")
 
-    fishing = Fishing(db)
-
-    if not species in fishing.species:
+    if not species in FISHING.species:
         return redirect('/collection-log')
 
-    species = fishing.species[species]
+    species = FISHING.species[species]
 
     return render_template(
         "fishing_species.html",
         user=user,
         stats=user.fish_catches_species_stats(species.name),
+        longest=db.record_catches('length', species=species.name)[:1],
+        heaviest=db.record_catches('weight', species=species.name)[:1],
         species=species
     )
 
@@ -328,40 +380,45 @@ def fishing_catch(location):
     if not user:
         return redirect("/login")
 
-    fishing = Fishing(db)
+    location = FISHING.location(location)
 
     # If requested location doesn't exist, return an error
-    if not hasattr(fishing, location):
+    if not location:
         return render_template(
-            "fishing.html"
+            "fishing.html",
+            fishing=FISHING
         )
 
-    if user.fished_today >= fishing.fishing_attempts_allowed:
-        return render_template(
-            "fishing_location.html",
-            error=f"You caught {fishing.fishing_attempts_allowed} fish today. Return tomorrow!",
-            location=getattr(fishing, location),
-            user=user
-        )
+    # Hold the angler's account so two catches at once can't both get past the daily limit
+    with db.accounts(user.id):
+        if user.fished_today >= FISHING.fishing_attempts_allowed:
+            return render_template(
+                "fishing_location.html",
+                error=f"You caught {FISHING.fishing_attempts_allowed} fish today. Return tomorrow!",
+                location=location,
+                catches=db.record_catches('length', location_id=location.id),
+                catch_count=db.catch_count(location.id),
+                user=user
+            )
 
-    # If user is logged in AND haven't caught a fish today, generate a new fish!
-    fish = getattr(fishing, location).drop_table.get_drop()
+        # If user is logged in AND haven't caught a fish today, generate a new fish!
+        fish = location.drop_table.get_drop()
 
-    # Record the catch
-    db.write_fish_catch(
-        species=fish.species.name,
-        weight_lbs=fish.weight_lbs,
-        length_in=fish.length_in,
-        angler_id=user.id,
-        location_id=location
-    )
+        # Record the catch
+        db.write_fish_catch(
+            species=fish.species.name,
+            weight_lbs=fish.weight_lbs,
+            length_in=fish.length_in,
+            angler_id=user.id,
+            location_id=location.id
+        )
 
-    # Then send the LBC
-    db.write_transaction(
-        user_from=0,
-        user_to=user.id,
-        amount=fish.species.value_lbc
-    )
+        # Then send the LBC
+        db.write_transaction(
+            user_from=0,
+            user_to=user.id,
+            amount=fish.species.value_lbc
+        )
 
     return render_template(
         "fish_catch.html",
@@ -376,21 +433,88 @@ def collection_log():
     if not user:
         return redirect("/login")
 
-    fishing = Fishing(db)
-
     return render_template(
         "collection_log.html",
         user=user,
-        fishing=fishing
+        fishing=FISHING
     )
 
 @app.route("/ledger")
+@cached
 def ledger():
-    user = authentication_check(request)
+    page = db.transaction_page(**page_args(request))
     return render_template(
         "ledger.html",
-        transactions=db.transaction_list()
-    )
+        transactions=page['transactions'],
+        newer=page['newer'],
+        older=page['older']
+    )
+
+# Read-only JSON API
+#
+# Every response carries an ETag naming the database generation it was
+# built from. A request whose If-None-Match still matches is answered 304
+# before any data is read.
+
+def api_response(build):
+    etag = f'{db.instance}-{db.generation}'
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    return response
+
+def api_user(user):
+    # Public fields only; never the password hash
+    return {
+        'id': user.id,
+        'username': user.username,
+        'nickname': user.nickname,
+        'created_at': user.created_at,
+        'balance': user.balance,
+        'token_count': user.token_count,
+        'transaction_count': user.transaction_count
+    }
+
+@app.route("/api/v1/ledger")
+def api_ledger():
+    return api_response(lambda: db.transaction_page(**page_args(request)))
+
+@app.route("/api/v1/leaderboard")
+def api_leaderboard():
+    def build():
+        by, page, pages = leaderboard_args(request)
+        users = db.leaderboard(by, (page - 1) * PAGE_SIZE, PAGE_SIZE)
+        return {
+            'by': by,
+            'page': page,
+            'pages': pages,
+            'users': [api_user(user) | {'score': score} for user, score in users]
+        }
+    return api_response(build)
+
+@app.route("/api/v1/market")
+def api_market():
+    def build():
+        listings = []
+        for listing in reversed(db.for_sale().values()):
+            token = db.tokens[listing.token_id]
+            listings.append(dict(listing) | {'note': token.note, 'url': token.url})
+        return {'listings': listings}
+    return api_response(build)
+
+@app.route("/api/v1/users/<username>")
+def api_user_detail(username):
+    def build():
+        user = db.get_user(username)
+        if not user:
+            abort(404)
+        return api_user(user) | {
+            'tokens': user.token_page(limit=PAGE_SIZE),
+            'transactions': user.transaction_page(limit=PAGE_SIZE)['transactions']
+        }
+    return api_response(build)
 
 @app.route("/studio")
 def studio():
@@ -588,16 +712,17 @@ def transaction():
             if not db.get_user(user_to):
                 return render_template("send_lbc.html", user=user_from, users=db.user_list(user_from), error="Recipient does not exist.")
 
-            if amount > user_from.balance:
-                return render_template("send_lbc.html", user=user_from, users=db.user_list(user_from), error="Insufficient balance")
-
-            db.write_transaction(
-                user_from=user_from.id,
-                user_to=db.get_user(user_to).id,
-                amount=amount
-            )
+            # Balance is checked inside the transfer, atomically with the write
+            try:
+                event = db.transfer(
+                    user_from=user_from.id,
+                    user_to=db.get_user(user_to).id,
+                    amount=amount
+                )
+            except TransactionError as e:
+                return render_template("send_lbc.html", user=user_from, users=db.user_list(user_from), error=str(e))
 
-            return render_template("success.html", event=db.transactions[max(db.transactions.keys())], type="lbc")
+            return render_template("success.html", event=event, type="lbc")
 
         case 'nft':
             user_to = request.form.get("to")
@@ -616,22 +741,17 @@ def transaction():
             if not db.get_user(user_to):
                 return render_template("send_nft.html", user=user_from, users=db.user_list(user_from), error="Recipient does not exist.")
 
-            if db.get_user(user_to).id == token.owner.id:
-                return render_template("send_nft.html", user=user_from, users=db.user_list(user_from), error="You can't send tokens to yourself.")
+            # Ownership and listing are checked inside send_token, atomically with the write
+            try:
+                event = db.send_token(
+                    user_from=user_from.id,
+                    user_to=db.get_user(user_to).id,
+                    token_id=token.id
+                )
+            except TransactionError as e:
+                return render_template("send_nft.html", user=user_from, users=db.user_list(user_from), error=str(e))
 
-            if not token.id in user_from.tokens:
-                return render_template("send_nft.html", user=user_from, users=db.user_list(user_from), error="You can only send Tokens you own.")
-            
-            if token.for_sale:
-                return render_template("send_nft.html", user=user_from, users=db.user_list(user_from), error="You can't send a token listed for sale.")
-
-            db.write_transaction(
-                user_from=user_from.id,
-                user_to=db.get_user(user_to).id,
-                token=token.id
-            )
-
-            return render_template("success.html", event=db.transactions[max(db.transactions.keys())], type="nft")
+            return render_template("success.html", event=event, type="nft")
 
         case 'buy':
 
@@ -649,46 +769,18 @@ def transaction():
 
             token = db.get_token(token_id)
 
-            # Check token is for sale
-            if not token.for_sale:
-                return render_template("purchase.html", token=token, error="Token is not for sale.")
-            
-            # Check buyer doesn't already own this item
-            if token.id in user_from.tokens:
-                return render_template("purchase.html", token=token, error="You already own this item.")
-
-            # Check buyer has sufficient balance
-            if user_from.balance < token.listing.amount:
-                return render_template("purchase.html", token=token, error="Insufficient balance.")
-            
-            # Check it's not being purchased for a negative amount
-            if token.listing.amount < 0:
-                return render_template("purchase.html", token=token, error="Negative purchase amount.")
-
-            # Send LBC from buyer to seller
-            db.write_transaction(
-                user_from=user_from.id,
-                user_to=token.owner.id,
-                token=None,
-                amount=token.listing.amount
-            )
-
-            # Send NFT from seller to buyer
-            db.write_transaction(
-                user_from=token.owner.id,
-                user_to=user_from.id,
-                token=token.id,
-                amount=None
-            )
-
-            # System removes for sale listing
-            db.write_listing(
-                seller_id=0,
-                token_id=token.id,
-                amount=None
-            )
+            # Check the token is for sale, the buyer doesn't already own it
+            # and can afford it, then pay the seller, send the token and take
+            # down the listing. All in one step so two buyers can't both win.
+            try:
+                event = db.purchase(
+                    buyer_id=user_from.id,
+                    token_id=token.id
+                )
+            except TransactionError as e:
+                return render_template("purchase.html", token=token, error=str(e))
 
-            return render_template("success.html", event=db.listings[max(db.listings.keys())], type="buy")
+            return render_template("success.html", event=event, type="buy")
 
         case 'list':
 
@@ -720,22 +812,17 @@ def transaction():
 
             token = db.get_token(token_id)
 
-            # Check token is not already for sale
-            if token.for_sale:
-                return render_template("sell.html", token=token, error="Token is already for sale.")
-            
-            # Check seller owns this item
-            if not token.id in user_from.tokens:
-                return render_template("sell.html", token=token, error="You don't own this item.")
-
-            # Create Listing
-            db.write_listing(
-                seller_id=user_from.id,
-                token_id=token.id,
-                amount=amount
-            )
-
-            return render_template("success.html", event=db.listings[max(db.listings.keys())], type="list")
+            # Create Listing if the token isn't already for sale and the seller owns it
+            try:
+                event = db.list_token(
+                    seller_id=user_from.id,
+                    token_id=token.id,
+                    amount=amount
+                )
+            except TransactionError as e:
+                return render_template("sell.html", token=token, error=str(e))
+
+            return render_template("success.html", event=event, type="list")
         
         case 'unlist':
 
@@ -753,22 +840,16 @@ def transaction():
 
             token = db.get_token(token_id)
 
-            # Check token isn't not listed for sale
-            if not token.for_sale:
-                return render_template("unlist.html", token=token, error="Token is not listed for sale.")
-            
-            # Check seller owns this item
-            if not token.id in user_from.tokens:
-                return render_template("unlist.html", token=token, error="You don't own this item.")
-
-            # Create Listing
-            db.write_listing(
-                seller_id=user_from.id,
-                token_id=token.id,
-                amount=None
-            )
+            # Remove the listing if the token is listed and the seller owns it
+            try:
+                event = db.unlist_token(
+                    seller_id=user_from.id,
+                    token_id=token.id
+                )
+            except TransactionError as e:
+                return render_template("unlist.html", token=token, error=str(e))
 
-            return render_template("success.html", event=db.listings[max(db.listings.keys())], type="unlist")
+            return render_template("success.html", event=event, type="unlist")
 
         case _:
             return redirect("wallet")
@@ -852,6 +933,15 @@ def success():
         user=user
     )
 
+def page_args(request):
+    # Cursor and page size from ?before=, ?after= and ?limit=
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return {
+        'before': request.args.get('before', type=int),
+        'after': request.args.get('after', type=int),
+        'limit': min(max(limit, 1), MAX_PAGE_SIZE)
+    }
+
 def authentication_check(request):
     # Check if browser session exists.
     session = request.cookies.get('session')
@@ -0,0 +1,44 @@
+from activities.fishing import FISHING
+
+# Achievements shown on users' cards.
+#
+# Each rule answers holds() from state the database already keeps up to
+# date as records are written (rankings, species caught), so reading a
+# user's awards never scans other users or the ledger. New rules should
+# do the same: add whatever they need to Database.index() and look it up
+# here.
+
+class Achievement:
+    def __init__(self, name, icon):
+        self.name = name
+        self.icon = icon
+
+    def holds(self, db, user):
+        return True
+
+class Leader(Achievement):
+    # First place on one of the leaderboards (see Database.rankings).
+    # Users tied for first all hold it.
+    def __init__(self, name, icon, ranking):
+        super().__init__(name, icon)
+        self.ranking = ranking
+
+    def holds(self, db, user):
+        ranking = db.rankings[self.ranking]
+        if user.id not in ranking.scores:
+            return False
+        return ranking.score(user.id) == ranking.top(1)[0][1]
+
+class AllSpecies(Achievement):
+    # Caught every species in the fishing game
+    def holds(self, db, user):
+        return len(db.species_caught.get(user.id, ())) >= len(FISHING.species)
+
+# In the order they're shown. The blank badge is held by everyone so every
+# card has one.
+ACHIEVEMENTS = (
+    Leader('Most LBC', 'award1.png', 'balance'),
+    Leader('Most NFT', 'award2.png', 'tokens'),
+    AllSpecies('All Species', 'award3.png'),
+    Achievement('', 'award0.png'),
+)
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+import openpyxl
+
+from db import Database
+
+# Cold-start time against ledger size.
+#
+#   python benchmark.py [transactions ...]
+#
+# For each size a synthetic db.xlsx is generated, then opened three ways:
+#   xlsx      parse the workbook, no snapshot
+#   snapshot  first start: parse the workbook and write the snapshot
+#   warm      later starts: load the snapshot only
+
+SHEETS = {
+    'users': ['id', 'username', 'password', 'nickname', 'created_at', 'admin'],
+    'tokens': ['id', 'created_at', 'note', 'link', 'disabled', 'hash'],
+    'transactions': ['id', 'timestamp', 'from', 'to', 'amount', 'token'],
+    'listings': ['id', 'timestamp', 'seller_id', 'token_id', 'amount'],
+    'fish_catches': ['id', 'timestamp', 'species', 'weight_lbs', 'length_in', 'angler', 'location_id'],
+    'submissions': ['id', 'created_at', 'author_id', 'token_id', 'reviewed'],
+}
+
+def make_workbook(path, transactions, users=100, tokens=100):
+    random.seed(0)
+    now = datetime.datetime.now().isoformat()
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet, headers in SHEETS.items():
+        workbook.create_sheet(sheet).append(headers)
+
+    for id in range(users):
+        workbook['users'].append([id, f'user{id}', 'x', f'User {id}', now, False])
+
+    for id in range(1, tokens+1):
+        workbook['tokens'].append([id, now, f'Token {id}', f'https://example.com/{id}.jpg', False, f'{id:x}'])
+        workbook['submissions'].append([id, now, random.randrange(1, users), id, True])
+        workbook['transactions'].append([id, now, 0, random.randrange(1, users), None, id])
+
+    for id in range(tokens+1, transactions+1):
+        workbook['transactions'].append([id, now, 0, random.randrange(1, users), random.randint(1, 6), None])
+        workbook['fish_catches'].append([id-tokens, now, 'scup', random.random()*4, random.random()*18, random.randrange(1, users), 'estuary'])
+
+    workbook['listings'].append([1, now, 1, 1, 100])
+    workbook.save(path)
+
+def timed(path, **options):
+    started = time.perf_counter()
+    Database(path, **options)
+    return time.perf_counter() - started
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+
+    print(f'{"transactions":>12} {"xlsx":>9} {"snapshot":>9} {"warm":>9}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.xlsx')
+            make_workbook(path, size)
+
+            xlsx = timed(path, snapshot=False)
+            snapshot = timed(path)
+            warm = timed(path)
+
+        print(f'{size:>12} {xlsx:>8.3f}s {snapshot:>8.3f}s {warm:>8.3f}s')
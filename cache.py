@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+class ResponseCache:
+    # Rendered pages keyed by (route, arguments), each stored with the
+    # database generation it was rendered at. An entry is only served
+    # while the generation is unchanged, so any write invalidates the
+    # whole cache without touching it.
+    #
+    # Bounded by entry count and by total size, evicting the least recently
+    # used entries first. Concurrent misses for the same key and
+    # generation wait for a single render instead of each rendering.
+
+    def __init__(self, max_entries=512, max_bytes=64_000_000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (generation, page)
+        self.size = 0                   # Total length of the cached pages
+        self.flights = {}               # (key, generation) -> Flight being rendered
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, generation, render):
+        # The page for key at this generation, rendering it if needed.
+        # Only str results are cached; anything else (a redirect, say) is
+        # returned as is and each waiter renders its own.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self.flights.get((key, generation))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(key, generation)] = Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if isinstance(flight.page, str):
+                return flight.page
+            return render()
+
+        try:
+            flight.page = render()
+        finally:
+            with self.lock:
+                del self.flights[(key, generation)]
+                if isinstance(flight.page, str):
+                    self.store(key, generation, flight.page)
+            flight.done.set()
+        return flight.page
+
+    def store(self, key, generation, page):
+        # Called with the lock held
+        if len(page) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old:
+            self.size -= len(old[1])
+        self.entries[key] = (generation, page)
+        self.size += len(page)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            key, (generation, page) = self.entries.popitem(last=False)
+            self.size -= len(page)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+class Flight:
+    # One render in progress, waited on by concurrent misses
+    def __init__(self):
+        self.done = threading.Event()
+        self.page = None
@@ -0,0 +1,99 @@
+import datetime
+import numpy as np
+
+class TransactionColumns:
+    # The transactions table as typed column arrays, for aggregates over the
+    # whole ledger (audits, rebuilding projections, analytics).
+    #
+    #   id          int64
+    #   timestamp   float64     seconds since the epoch, UTC
+    #   sender      int64       the 'from' column
+    #   recipient   int64       the 'to' column
+    #   amount      int64       0 when the transaction moves a token
+    #   token       int64       -1 when the transaction moves LBC
+    #
+    # Arrays grow by doubling, so appending one transaction is amortized O(1).
+    # The live rows are the first `size` entries of each array.
+
+    columns = {
+        'id': np.int64,
+        'timestamp': np.float64,
+        'sender': np.int64,
+        'recipient': np.int64,
+        'amount': np.int64,
+        'token': np.int64,
+    }
+
+    def __init__(self, transactions=(), capacity=1024):
+        self.size = 0
+        self.arrays = {name: np.empty(capacity, dtype) for name, dtype in self.columns.items()}
+        for transaction in transactions:
+            self.append(transaction)
+
+    def __len__(self):
+        return self.size
+
+    def __getattr__(self, name):
+        # self.amount etc. -> the live part of that column
+        arrays = self.__dict__.get('arrays')
+        if arrays is None or name not in arrays:
+            raise AttributeError(name)
+        return arrays[name][:self.size]
+
+    def append(self, transaction):
+        if self.size == len(self.arrays['id']):
+            for name, array in self.arrays.items():
+                grown = np.empty(2 * len(array), array.dtype)
+                grown[:self.size] = array[:self.size]
+                self.arrays[name] = grown
+
+        i = self.size
+        self.arrays['id'][i] = transaction.id
+        self.arrays['timestamp'][i] = epoch(transaction.timestamp)
+        self.arrays['sender'][i] = getattr(transaction, 'from')
+        self.arrays['recipient'][i] = getattr(transaction, 'to')
+        self.arrays['amount'][i] = transaction.amount or 0
+        self.arrays['token'][i] = transaction.token or -1
+        self.size += 1
+
+    def users(self):
+        # One past the largest user id seen, the length of per-user arrays
+        if not self.size:
+            return 0
+        return int(max(self.sender.max(), self.recipient.max())) + 1
+
+    def received(self):
+        # LBC received per user id
+        return np.bincount(self.recipient, weights=self.amount, minlength=self.users()).astype(np.int64)
+
+    def sent(self):
+        # LBC sent per user id. The system account minting to itself
+        # (from 0 to 0) creates LBC rather than sending it.
+        minted = (self.sender == 0) & (self.recipient == 0)
+        amount = np.where(minted, 0, self.amount)
+        return np.bincount(self.sender, weights=amount, minlength=self.users()).astype(np.int64)
+
+    def balances(self):
+        # Balance per user id, the same numbers as Ledger.balance()
+        return self.received() - self.sent()
+
+    def circulating_supply(self):
+        # LBC held by everyone except the system account
+        return int(self.balances()[1:].sum())
+
+    def owners(self):
+        # token id -> user id of its current owner, the same as Ledger.owner()
+        moves = (self.token > 0) & (self.amount == 0)
+        tokens = self.token[moves][::-1]
+        recipients = self.recipient[moves][::-1]
+        # np.unique keeps the first occurrence, which is the last transfer
+        tokens, first = np.unique(tokens, return_index=True)
+        return dict(zip(tokens.tolist(), recipients[first].tolist()))
+
+    def between(self, start, end):
+        # Mask of transactions with start <= timestamp < end (datetimes, UTC)
+        return (self.timestamp >= start.timestamp()) & (self.timestamp < end.timestamp())
+
+def epoch(timestamp):
+    # Timestamps are stored as naive ISO strings in UTC
+    return datetime.datetime.fromisoformat(timestamp).replace(tzinfo=datetime.UTC).timestamp()
@@ -1,69 +1,499 @@
-import openpyxl
+import os
+import sys
+import pickle
 import datetime
+import threading
 import uuid
+import functools
+from contextlib import contextmanager
+from collections import defaultdict
 import json
 import pytz
 from PIL import Image
 import requests
 
+from storage import open_storage, GroupCommitter
+from ledger import Ledger, paginate
+from ledgerfile import MappedTable, map_table
+from sessions import SessionStore
+from ranking import Ranking, CatchRecords
+from awards import ACHIEVEMENTS
+
+# Bump when the records or indexes change shape so old snapshots are ignored
+SNAPSHOT_VERSION = 9
+
 class Database:
-    def __init__(self, path):
-        self.path = path
-        self.workbook = openpyxl.load_workbook(path)
-        self.sessions = {}
+    # Shared by every request thread.
+    #
+    # Writes go through insert() and update() under write_lock, and checks
+    # that must still hold when their write lands take the accounts() locks.
+    # Readers take no lock. They look records up by id or read lists that
+    # are only appended to. Anything that walks a dict writers change in
+    # place copies it under write_lock first (see user_list()).
+
+    # What a snapshot holds: the tables and every index derived from them
+    snapshot_fields = (
+        'headers',
+        'patterns',
+        'users',
+        'tokens',
+        'transactions',
+        'listings',
+        'fish_catches',
+        'submissions',
+        'ledger',
+        'rankings',
+        'species_caught',
+        'catch_records',
+        'user_fish_catches',
+        'user_submissions',
+        'token_submissions',
+        'active_listings',
+        'usernames',
+        'nicknames',
+        'token_titles',
+        'token_urls',
+        'token_hashes',
+    )
 
-        self.load_db()
+    # Tables that can be served from memory-mapped record files, see ledgerfile.py
+    mappable = ('transactions', 'fish_catches')
+
+    def __init__(self, path, journal=True, checkpoint_every=1000, durability='sync', group_window=0.005, group_size=64, snapshot=True, mapped=False):
+        self.path = path
+        self.mapped = mapped
+        self.storage = open_storage(path, journal=journal)
+        self.checkpoint_every = checkpoint_every
+        self.snapshot_path = path + '.snapshot' if snapshot else None
+
+        # Held while changing tables or storage. Commits wait for the disk
+        # after releasing it. Checkpoints hold it while they save the
+        # workbook and snapshot, so they run on their own thread (see flush()).
+        self.write_lock = threading.RLock()
+        self.checkpointing = False  # A background checkpoint is running
+        self.committer = GroupCommitter(
+            self.flush,
+            self.write_lock,
+            mode=durability,
+            window=group_window,
+            max_batch=group_size
+        )
+        self.account_locks = {}     # user id -> Lock, see accounts()
+        self.sessions = SessionStore(path + '.sessions')
+        self.columns = None         # TransactionColumns, see transaction_columns()
+
+        # Bumped by every write. Together with the instance id it names one
+        # state of the data, e.g. for HTTP ETags.
+        self.instance = uuid.uuid4().hex[:12]
+        self.generation = 0
+
+        # Start from the snapshot when it matches the workbook on disk.
+        # Otherwise parse everything and leave a snapshot for next time.
+        if self.load_snapshot():
+            self.map_tables()
+        else:
+            self.load_db()
+            self.map_tables()
+            self.save_snapshot()
 
     def load_db(self):
-        self.users = self.load_data(self.workbook, 'users', User)
-        self.tokens = self.load_data(self.workbook, 'tokens', Token)
-        self.transactions = self.load_data(self.workbook, 'transactions', Transaction)
-        self.listings = self.load_data(self.workbook, 'listings', Listing)
-        self.fish_catches = self.load_data(self.workbook, 'fish_catches', FishCatches)
-        self.submissions = self.load_data(self.workbook, 'submissions', Submission)
+        self.headers = {}
+        self.patterns = {
+            'users': User,
+            'tokens': Token,
+            'transactions': Transaction,
+            'listings': Listing,
+            'fish_catches': FishCatches,
+            'submissions': Submission,
+        }
+        data = self.storage.load(list(self.patterns))
+        for worksheet, pattern in self.patterns.items():
+            setattr(self, worksheet, self.load_data(worksheet, pattern, *data[worksheet]))
+        self.build_indexes()
+
+        # The storage returns what was saved at the last checkpoint
+        if self.storage.journal:
+            for entry in self.storage.journal.entries():
+                self.replay(entry)
+
+    def build_indexes(self):
+        # Derived state kept up to date by index() as records are written
+        self.ledger = Ledger()
+        self.columns = None
+        self.rankings = {           # leaderboard name -> Ranking of users
+            'balance': Ranking(),   # LBC
+            'tokens': Ranking(),    # NFT held
+            'fish': Ranking(),      # fish caught
+        }
+        self.species_caught = defaultdict(dict) # user id -> {species: None}, in the order first caught
+        self.catch_records = CatchRecords()
+        self.user_fish_catches = defaultdict(list)  # user id -> ids of their catches, ascending
+        self.user_submissions = defaultdict(list)   # user id -> ids of their submissions, ascending
+        self.token_submissions = {} # token id -> id of the submission that made it
+        self.active_listings = {}   # token id -> current Listing
+        self.usernames = {}         # username -> User
+        self.nicknames = set()
+        self.token_titles = set()
+        self.token_urls = set()
+        self.token_hashes = set()
+
+        for worksheet in self.patterns:
+            for obj in getattr(self, worksheet).values():
+                self.index(worksheet, obj)
+
+    def index(self, worksheet, obj):
+        # Apply a new record to the derived state
+        match worksheet:
+            case 'users':
+                self.usernames[obj.username] = obj
+                self.nicknames.add(obj.nickname)
+                # The system account isn't ranked
+                if obj.id:
+                    for ranking in self.rankings.values():
+                        ranking.set(obj.id, 0)
+            case 'tokens':
+                self.token_titles.add(obj.note)
+                self.token_urls.add(obj.link)
+                self.token_hashes.add(obj.hash)
+            case 'transactions':
+                self.ledger.apply(obj)
+                if self.columns is not None:
+                    self.columns.append(obj)
+                for user_id in {getattr(obj, 'from'), getattr(obj, 'to')} - {0}:
+                    self.rankings['balance'].set(user_id, self.ledger.balance(user_id))
+                    self.rankings['tokens'].set(user_id, self.ledger.token_count(user_id))
+            case 'listings':
+                # A listing with an amount puts the token up for sale,
+                # one without takes it off the market.
+                if obj.amount:
+                    self.active_listings[obj.token_id] = obj
+                else:
+                    self.active_listings.pop(obj.token_id, None)
+            case 'fish_catches':
+                if obj.angler:
+                    self.rankings['fish'].add(obj.angler, 1)
+                self.species_caught[obj.angler].setdefault(obj.species)
+                self.catch_records.add(obj)
+                self.user_fish_catches[obj.angler].append(obj.id)
+            case 'submissions':
+                self.user_submissions[obj.author_id].append(obj.id)
+                self.token_submissions.setdefault(obj.token_id, obj.id)
+
+    def check_ledger(self):
+        # Rebuild the ledger projections from scratch and list any differences
+        with self.write_lock:
+            transactions = list(self.transactions.values())
+        return self.ledger.verify(transactions)
+
+    def transaction_columns(self):
+        # The transactions table as numpy column arrays. Built on first use,
+        # then kept up to date as transactions are written.
+        with self.write_lock:
+            if self.columns is None:
+                from columns import TransactionColumns
+                self.columns = TransactionColumns(self.transactions.values(), capacity=max(1024, len(self.transactions)))
+            return self.columns
+
+    def audit(self):
+        # Vectorized recount of every balance and token owner, compared with
+        # the ledger projections. Returns a list of differences.
+        return self.ledger.verify_columns(self.transaction_columns())
+
+    def load_snapshot(self):
+        # Returns False when there is no usable snapshot
+        signature = self.storage.signature()
+        if not self.snapshot_path or not signature or not os.path.exists(self.snapshot_path):
+            return False
+
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception:
+            return False
+
+        if snapshot['version'] != SNAPSHOT_VERSION or snapshot['signature'] != signature:
+            return False
+
+        for name in self.snapshot_fields:
+            setattr(self, name, snapshot['state'][name])
+        for worksheet in self.patterns:
+            table = getattr(self, worksheet)
+            if isinstance(table, MappedTable):
+                table.db = self
+                continue
+            for obj in table.values():
+                obj.db = self
+
+        # Catch up on writes journaled after the snapshot was taken
+        if self.storage.journal:
+            try:
+                for entry in self.storage.journal.entries(snapshot['journal_position']):
+                    self.replay(entry)
+            except KeyError:
+                # An update to a record the snapshot doesn't have, see below
+                return False
+
+        # The snapshot matching the workbook's signature isn't enough: one
+        # taken by another process on the same files (say the reloader's,
+        # next to the server's) can be missing rows the workbook has.
+        return self.rows_match_storage()
+
+    def rows_match_storage(self):
+        # Whether every table holds as many records as the workbook plus
+        # the journal appends to it. A crash between a checkpoint's save
+        # and its journal truncation double counts those rows, which only
+        # costs one full parse.
+        counts = self.storage.row_counts()
+        if self.storage.journal:
+            for entry in self.storage.journal.entries():
+                if entry['op'] == 'append' and counts.get(entry['sheet']) is not None:
+                    counts[entry['sheet']] += 1
+        return all(
+            counts.get(worksheet) is None or counts[worksheet] == len(getattr(self, worksheet))
+            for worksheet in self.patterns
+        )
+
+    def map_tables(self):
+        # With mapped=True, transactions and fish catches are served from
+        # record files on disk instead of being held as objects in memory.
+        # Records from a mapped table are built on each access, so unlike
+        # everywhere else their identity isn't stable.
+        for worksheet in self.mappable:
+            table = getattr(self, worksheet)
+            if self.mapped and not isinstance(table, MappedTable):
+                setattr(self, worksheet, map_table(self.path, worksheet, self.patterns[worksheet], self, table))
+            elif not self.mapped and isinstance(table, MappedTable):
+                setattr(self, worksheet, dict(table.items()))
+
+    def save_snapshot(self):
+        signature = self.storage.signature()
+        if not self.snapshot_path or not signature:
+            return
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'signature': signature,
+            'journal_position': self.storage.journal.position() if self.storage.journal else 0,
+            'state': {name: getattr(self, name) for name in self.snapshot_fields}
+        }
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.snapshot_path)
+
+    def replay(self, entry):
+        # Apply a journal entry to the loaded tables
+        match entry['op']:
+            case 'append':
+                if entry['row'][0] not in getattr(self, entry['sheet']):
+                    self.add(entry['sheet'], entry['row'])
+            case 'update':
+                obj = getattr(self, entry['sheet'])[entry['id']]
+                setattr(obj, entry['column'], entry['value'])
+
+    def commit(self):
+        # Returns once the writes so far are durable (see GroupCommitter)
+        self.committer.commit()
+
+    def flush(self):
+        # Called by the committer with write_lock held. Returns the wait for
+        # the disk, which the committer runs once the lock is released.
+        sync = self.storage.commit()
+        # Checkpoint off the request path, the writer that crossed the
+        # threshold doesn't wait for it
+        if self.storage.pending >= self.checkpoint_every and not self.checkpointing:
+            self.checkpointing = True
+            threading.Thread(target=self.background_checkpoint, name='checkpoint', daemon=True).start()
+        return sync
+
+    def background_checkpoint(self):
+        try:
+            self.checkpoint()
+        finally:
+            self.checkpointing = False
+
+    def commit_stats(self):
+        return self.committer.stats()
+
+    def checkpoint(self):
+        # Fold the journal into db.xlsx and snapshot the result. A no-op on SQLite.
+        with self.write_lock:
+            # Nothing to fold in: the workbook and snapshot are already
+            # current, so don't open and rewrite the workbook for nothing
+            if not self.storage.pending:
+                sync = self.storage.commit()
+                if sync:
+                    sync()
+                return
+            self.storage.checkpoint()
+            self.save_snapshot()
+
+    def next_id(self, worksheet):
+        # Rows are only ever appended, so the newest record has the largest id.
+        # Only call this holding write_lock, see insert().
+        return next(reversed(getattr(self, worksheet)), 0) + 1
+
+    def insert(self, worksheet, values):
+        # Persist a new row and add its record to the in-memory tables.
+        # Only the new record is built; everything already loaded is left as is.
+        # The id is allocated here, under the write lock, so concurrent
+        # writers never get the same one.
+        with self.write_lock:
+            row = [self.next_id(worksheet)] + list(values)
+            self.storage.append(worksheet, row)
+            return self.add(worksheet, row)
+
+    def add(self, worksheet, row):
+        # Build the record for a row and index it
+        obj = self.patterns[worksheet].from_row(self.headers[worksheet], row, self)
+        getattr(self, worksheet)[obj.id] = obj
+        self.index(worksheet, obj)
+        self.generation += 1
+        return obj
+
+    def update(self, worksheet, id, column, value):
+        # Persist a changed field and apply it to the loaded record
+        with self.write_lock:
+            self.storage.update(worksheet, id, column, value)
+            obj = getattr(self, worksheet)[id]
+            setattr(obj, column, value)
+            self.generation += 1
+        return obj
+
+    @contextmanager
+    def accounts(self, *user_ids):
+        # Hold the locks of every account involved in a check-then-write, e.g.
+        #
+        #   with db.accounts(buyer.id, seller.id):
+        #       if buyer.balance >= price: ...
+        #
+        # Locks are always taken in id order so two transfers between the
+        # same accounts can't deadlock. Transfers between other accounts
+        # carry on in parallel.
+        locks = [self.account_locks.setdefault(id, threading.Lock()) for id in sorted(set(user_ids))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
 
     def create_account(self, username, password, nickname):
-        worksheet=self.workbook['users']       
-        worksheet.append([
-            max(self.users.keys() or [0])+1,
+        user = self.insert('users', [
             username,
             password,
             nickname,
             datetime.datetime.now().isoformat(),
             False
         ])
-        self.workbook.save(self.path)
-        self.load_db()
+        self.commit()
+        return user
 
-    def write_transaction(self, user_from, user_to, amount=0, token=None):
-        worksheet=self.workbook['transactions']
-        worksheet.append([
-            max(self.transactions.keys())+1,
+    def new_transaction(self, user_from, user_to, amount=0, token=None):
+        return self.insert('transactions', [
             datetime.datetime.now().isoformat(),
             user_from,
             user_to,
             amount,
             token
         ])
-        self.workbook.save(self.path)
-        self.load_db()
 
-    def write_listing(self, seller_id, token_id, amount=None):
-        worksheet=self.workbook['listings']       
-        worksheet.append([
-            max(self.listings.keys())+1,
+    def new_listing(self, seller_id, token_id, amount=None):
+        return self.insert('listings', [
             datetime.datetime.now().isoformat(),
             seller_id,
             token_id,
             amount,
         ])
-        self.workbook.save(self.path)
-        self.load_db()
+
+    def write_transaction(self, user_from, user_to, amount=0, token=None):
+        transaction = self.new_transaction(user_from, user_to, amount, token)
+        self.commit()
+        return transaction
+
+    def write_listing(self, seller_id, token_id, amount=None):
+        listing = self.new_listing(seller_id, token_id, amount)
+        self.commit()
+        return listing
+
+    def transfer(self, user_from, user_to, amount):
+        # Send LBC. The balance check and the write happen under the
+        # sender's lock, so the same LBC can't be spent twice.
+        with self.accounts(user_from, user_to):
+            if user_from != 0 and amount > self.ledger.balance(user_from):
+                raise TransactionError("Insufficient balance")
+            transaction = self.new_transaction(user_from, user_to, amount=amount)
+        self.commit()
+        return transaction
+
+    def send_token(self, user_from, user_to, token_id):
+        with self.accounts(user_from, user_to):
+            if self.ledger.owner(token_id) == user_to:
+                raise TransactionError("You can't send tokens to yourself.")
+            if token_id not in self.ledger.holdings.get(user_from, {}):
+                raise TransactionError("You can only send Tokens you own.")
+            if token_id in self.active_listings:
+                raise TransactionError("You can't send a token listed for sale.")
+            transaction = self.new_transaction(user_from, user_to, token=token_id)
+        self.commit()
+        return transaction
+
+    def list_token(self, seller_id, token_id, amount):
+        with self.accounts(seller_id):
+            if token_id in self.active_listings:
+                raise TransactionError("Token is already for sale.")
+            if token_id not in self.ledger.holdings.get(seller_id, {}):
+                raise TransactionError("You don't own this item.")
+            listing = self.new_listing(seller_id, token_id, amount)
+        self.commit()
+        return listing
+
+    def unlist_token(self, seller_id, token_id):
+        with self.accounts(seller_id):
+            if token_id not in self.active_listings:
+                raise TransactionError("Token is not listed for sale.")
+            if token_id not in self.ledger.holdings.get(seller_id, {}):
+                raise TransactionError("You don't own this item.")
+            listing = self.new_listing(seller_id, token_id, None)
+        self.commit()
+        return listing
+
+    def purchase(self, buyer_id, token_id):
+        # Buy a listed token: LBC to the seller, the token to the buyer and
+        # the listing taken down, all while holding both accounts.
+        while True:
+            seller_id = self.ledger.owner(token_id)
+            with self.accounts(buyer_id, seller_id):
+                # The token changed hands before we got the locks. Try again.
+                if self.ledger.owner(token_id) != seller_id:
+                    continue
+
+                listing = self.active_listings.get(token_id)
+                if not listing:
+                    raise TransactionError("Token is not for sale.")
+                if token_id in self.ledger.holdings.get(buyer_id, {}):
+                    raise TransactionError("You already own this item.")
+                if self.ledger.balance(buyer_id) < listing.amount:
+                    raise TransactionError("Insufficient balance.")
+                if listing.amount < 0:
+                    raise TransactionError("Negative purchase amount.")
+
+                # Send LBC from buyer to seller
+                self.new_transaction(buyer_id, seller_id, token=None, amount=listing.amount)
+
+                # Send NFT from seller to buyer
+                self.new_transaction(seller_id, buyer_id, token=token_id, amount=None)
+
+                # System removes for sale listing
+                unlisting = self.new_listing(0, token_id, None)
+                break
+
+        self.commit()
+        return unlisting
 
     def write_fish_catch(self, species, weight_lbs, length_in, angler_id, location_id):
-        worksheet=self.workbook['fish_catches']       
-        worksheet.append([
-            max(self.fish_catches.keys() or [0])+1,
+        fish_catch = self.insert('fish_catches', [
             datetime.datetime.now().isoformat(),
             species,
             weight_lbs,
@@ -71,39 +501,31 @@ class Database:
             angler_id,
             location_id
         ])
-        self.workbook.save(self.path)
-        self.load_db()
+        self.commit()
+        return fish_catch
 
     def write_new_token_submission(self, token_note, token_url, token_hash, token_author_id):
 
         # First create a new token record
         # Token is disabled=True
-        token_id = max(self.tokens.keys() or [0])+1
-
-        worksheet=self.workbook['tokens']
-        worksheet.append([
-            token_id,
+        token = self.insert('tokens', [
             datetime.datetime.now().isoformat(),
             token_note,
             token_url,
             True,
             token_hash
         ])
-        self.workbook.save(self.path)
 
         # Then create submission for that token
         # reviewed = False
-        worksheet=self.workbook['submissions']       
-        worksheet.append([
-            max(self.submissions.keys() or [0])+1,
+        submission = self.insert('submissions', [
             datetime.datetime.now().isoformat(),
             token_author_id,
-            token_id,
+            token.id,
             False
         ])
-        self.workbook.save(self.path)
-
-        self.load_db()
+        self.commit()
+        return submission
 
     def submission_approve(self, submission_id):
         # Submission is approved
@@ -113,14 +535,10 @@ class Database:
         submission = self.submissions[submission_id]
 
         # 1. Set Submission reviewed = True
-        worksheet=self.workbook['submissions']
-        worksheet.cell(row=submission_id+1, column=5).value = True
-        self.workbook.save(self.path)
+        self.update('submissions', submission_id, 'reviewed', True)
 
         # 2. Set Token disabled = False
-        worksheet=self.workbook['tokens']
-        worksheet.cell(row=submission.token.id+1, column=5).value = False
-        self.workbook.save(self.path)
+        self.update('tokens', submission.token.id, 'disabled', False)
 
         # 3. Send Token from System to User
         self.write_transaction(
@@ -128,89 +546,63 @@ class Database:
             user_to=submission.author.id,
             token=submission.token.id
         )
-
-        self.workbook.save(self.path)
-        self.load_db()
+        return submission
 
     def submission_deny(self, submission_id):
         # Submission is denied
         # 1. Set Submission reviewed = True
         # 2. Delete Token
-        worksheet=self.workbook['submissions']
-        worksheet.cell(row=submission_id+1, column=5).value = True
-        self.workbook.save(self.path)
-        self.load_db()
+        submission = self.update('submissions', submission_id, 'reviewed', True)
+        self.commit()
+        return submission
 
     def update_user_password(self, user, password):
         # Update user password
-        worksheet=self.workbook['users']
-        worksheet.cell(row=user.id+2, column=3).value = password
-        self.workbook.save(self.path)
-        self.load_db()
-
-    def load_data(self, workbook, worksheet, pattern):
-        first = True
-        headers = None
+        user = self.update('users', user.id, 'password', password)
+        self.commit()
+        return user
+
+    def load_data(self, worksheet, pattern, headers, rows):
+        self.headers[worksheet] = headers
         data = {}
-        for i, row in enumerate(workbook[worksheet].iter_rows(values_only=True)):
-            if first:
-                headers = row
-                first = False
-            else:
-                rowdict = dict()
-                for i, header in enumerate(headers):
-                    rowdict[header] = row[i]
-                obj = pattern(rowdict, self)
-                data[obj.id] = obj
+        for row in rows:
+            obj = pattern.from_row(headers, row, self)
+            data[obj.id] = obj
         return data
         
     def get_user(self, username):
-        for id,user in self.users.items():
-            if user.username == username:
-                return user
-        return None
+        return self.usernames.get(username)
     
     def get_token(self, token_id):
-        for id,token in self.tokens.items():
-            if token.id == token_id:
-                return token
-        return None
+        return self.tokens.get(token_id)
 
     def get_all_token_titles(self):
-        token_titles = []
-        for id,token in self.tokens.items():
-            token_titles.append(token.note)
-        return token_titles
+        return self.token_titles
     
     def get_all_token_urls(self):
-        token_urls = []
-        for id,token in self.tokens.items():
-            token_urls.append(token.note)
-        return token_urls
+        return self.token_urls
     
     def get_all_token_hashes(self):
-        token_hashes = []
-        for id,token in self.tokens.items():
-            token_hashes.append(token.hash)
-        return token_hashes
+        return self.token_hashes
 
     def start_session(self, username):
-        session = Session(username)
-        self.sessions[username] = session
-        return session
+        return self.sessions.start(username)
 
     def end_session(self, username):
-        self.sessions.pop(username)
+        self.sessions.end(username)
 
     def check_session(self, token):
-        for id,session in self.sessions.items():
-            if session.token == token:
-                return self.get_user(session.username)
-        return None
+        session = self.sessions.get(token)
+        if not session:
+            return None
+        return self.get_user(session.username)
 
     def user_list(self, user):
+        # Writers add to the tables in place, so take a copy to walk
+        with self.write_lock:
+            all_users = list(self.users.values())
         users = []
-        for id,u in self.users.items():
+        for u in all_users:
             if u.username == 'system':
                 continue
             if u.username == user.username:
@@ -219,182 +611,192 @@ class Database:
         return users
     
     def all_usernames(self):
-        usernames = []
-        for id,user in self.users.items():
-            usernames.append(user.username)
-        return usernames
+        return self.usernames.keys()
     
     def all_nicknames(self):
-        nicknames = []
-        for id,user in self.users.items():
-            nicknames.append(user.nickname)
-        return nicknames
-
-    def transaction_list(self):
-        transactions = []
-        for i,t in self.transactions.items():
-            transactions.append(t.to_dict())
-        transactions.reverse()
-        return transactions
+        return self.nicknames
+
+    def transaction_page(self, before=None, after=None, limit=50, user_id=None):
+        # A page of the ledger, or of one user's transactions, newest first,
+        # with cursors for the pages either side of it (see ledger.paginate)
+        ids = self.ledger.ids if user_id is None else self.ledger.transactions(user_id)
+        ids, newer, older = paginate(ids, before, after, limit)
+        return {
+            'transactions': [self.transactions[id].to_dict() for id in ids],
+            'newer': newer,
+            'older': older
+        }
+
+    def catch_count(self, location_id):
+        return self.catch_records.counts.get(location_id, 0)
+
+    def record_catches(self, measure='length', location_id=None, species=None):
+        # The record catches (10 at most), best first, by 'length' or
+        # 'weight', at a location or of a species
+        if location_id is not None:
+            ids = self.catch_records.top(measure, 'location', location_id)
+        else:
+            ids = self.catch_records.top(measure, 'species', species)
+        return [self.fish_catches[id] for id in ids]
+
+    def leaderboard(self, by='balance', start=0, limit=50):
+        # Users with a score above zero on one of the rankings, highest
+        # first, as (User, score) pairs
+        ranking = self.rankings[by]
+        limit = max(min(limit, ranking.ranked() - start), 0)
+        return [(self.users[id], score) for id, score in ranking.top(limit, start)]
 
     def for_sale(self):
-        for_sale = {}
-        for id,listing in self.listings.items():
-            if listing.amount:
-                for_sale[listing.token.id] = listing
-            else:
-                for_sale.pop(listing.token.id)
-        return for_sale
+        # Token id -> Listing for every token currently on the market.
+        # A copy, so callers can walk it while listings change.
+        with self.write_lock:
+            return dict(self.active_listings)
     
     def pending_submissions(self):
+        with self.write_lock:
+            submissions = list(self.submissions.values())
         subs = []
         
-        for id, sub in self.submissions.items():
+        for sub in submissions:
             if not sub.reviewed:
                 subs.append(sub)
         
         return subs
 
-class Object:
-    def __init__(self, d, db):
-        self.db = db
-        for key in d:
-            setattr(self, key, d[key])
+class TransactionError(Exception):
+    # A transfer, listing or purchase that failed its checks.
+    # The message is shown to the user.
+    pass
+
+class Record:
+    # Base class of the rows of every table.
+    #
+    # Each subclass lists its columns in `fields`, which become its
+    # __slots__, so a record carries no per-instance __dict__. Columns named
+    # in `interned` hold a small set of repeated strings and share one
+    # copy of each.
+    #
+    # `memo` holds the values of @memoized properties (see below).
+
+    __slots__ = ('db', 'memo')
+    fields = ()
+    interned = ()
+
+    # (class, headers) -> position of each field in a row laid out like headers
+    layouts = {}
+
+    @classmethod
+    def from_row(cls, headers, row, db):
+        # Build a record straight from a row's values, column by column
+        layout = Record.layouts.get((cls, headers))
+        if layout is None:
+            layout = [(f, headers.index(f) if f in headers else None) for f in cls.fields]
+            Record.layouts[(cls, headers)] = layout
+
+        obj = cls.__new__(cls)
+        obj.db = db
+        obj.memo = None
+        for field, i in layout:
+            setattr(obj, field, row[i] if i is not None else None)
+        obj.intern()
+        return obj
+
+    def intern(self):
+        for field in self.interned:
+            value = getattr(self, field)
+            if type(value) is str:
+                setattr(self, field, sys.intern(value))
+
+    def __getstate__(self):
+        # Records are pickled into snapshots without the database they belong to
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def __setstate__(self, state):
+        self.memo = None
+        for field, value in zip(self.fields, state):
+            setattr(self, field, value)
+        self.intern()
 
     def __iter__(self):
-        for p in dir(self):
-            if not p.startswith('__'):
-                yield p, getattr(self, p)
+        # The stored columns only. Properties are never evaluated.
+        for field in self.fields:
+            yield field, getattr(self, field)
 
     def __repr__(self):
-        d = {}
-        for p in dir(self):
-            if p.startswith('__'):
-                continue
-            if p == 'db':
-                continue
-
-            if type(getattr(self, p)) == User:
-                d[p] = dict(getattr(self, p))
-            else:
-                d[p] = getattr(self, p)
-
-        return json.dumps(d)
-
-class User(Object):
+        return json.dumps(dict(self))
+
+def memoized(method):
+    # A property whose value is kept on the record until the database's
+    # next write, so templates can read it repeatedly at no cost. Only for
+    # values that depend on nothing but the data (not the clock), and that
+    # callers treat as read-only.
+    name = method.__name__
+
+    @functools.wraps(method)
+    def getter(self):
+        generation = self.db.generation
+        if self.memo is None or self.memo[0] != generation:
+            self.memo = (generation, {})
+        values = self.memo[1]
+        if name not in values:
+            values[name] = method(self)
+        return values[name]
+
+    return property(getter)
+
+class User(Record):
+    fields = ('id', 'username', 'password', 'nickname', 'created_at', 'admin')
+    __slots__ = fields
 
     @property
     def awards(self):
+        # See awards.py. The first one is shown on the user's card.
+        return [award for award in ACHIEVEMENTS if award.holds(self.db, self)]
 
-        awards = []
-
-        # Achievement 1 : Most LBC
-        a1 = True
-        for id,user in self.db.users.items():
-            if id == 0:
-                continue
-            if user.balance > self.balance:
-                a1 = False
-        if a1:
-            awards.append(
-                Achievement('Most LBC', 'award1.png')
-            )
-
-        # Achievement 2 : Most NFT
-        a2 = True
-        for id,user in self.db.users.items():
-            if id == 0:
-                continue
-            if len(user.tokens) > len(self.tokens):
-                a2 = False
-        if a2:
-            awards.append(
-                Achievement('Most NFT', 'award2.png')
-            )
-
-        # Achievement 3 : 100% Collection Log
-        a3 = True
-        from activities.fishing import Fishing
-        fishing = Fishing(self.db)
-        if len(self.fish_species) < len(fishing.species):
-            a3 = False 
-        if a3:
-            awards.append(
-                Achievement('All Species', 'award3.png')
-            )
-
-        awards.append(Achievement('', 'award0.png'))
-
-        return awards
-
-    @property
+    @memoized
     def tokens(self):
         tokens = {}
-        for id, transaction in self.db.transactions.items():
-
-            if getattr(transaction, 'to') is self.id and transaction.token:
-                tokens[transaction.token] = self.db.tokens[transaction.token].to_dict()
-
-            if getattr(transaction, 'from') is self.id and transaction.token and getattr(transaction, 'from') != getattr(transaction, 'to'):
-                if transaction.token in tokens:
-                    tokens.pop(transaction.token)
-        
-        tokens = dict(reversed(tokens.items()))
+        for token_id in self.db.ledger.tokens(self.id):
+            tokens[token_id] = self.db.tokens[token_id].to_dict()
         return tokens
 
     @property
-    def balance(self):
-        balance = 0
-
-        for id, transaction in self.db.transactions.items():
+    def token_count(self):
+        return self.db.ledger.token_count(self.id)
 
-            if getattr(transaction, 'to') is self.id and transaction.amount:
-                balance += transaction.amount
+    def token_page(self, page=1, limit=50):
+        # Token dicts for one page of the gallery, most recently received first
+        start = (page - 1) * limit
+        return [self.db.tokens[id].to_dict() for id in self.db.ledger.tokens(self.id, start, start + limit)]
 
-            if getattr(transaction, 'from') is self.id and transaction.amount:               
-                if getattr(transaction, 'to') == getattr(transaction, 'from') and self.id == 0:
-                    continue
+    @property
+    def balance(self):
+        return self.db.ledger.balance(self.id)
 
-                balance -= transaction.amount
-        
-        return balance
+    def rank(self, by='balance'):
+        # Place on one of the leaderboards (see Database.rankings), 1 is top
+        return self.db.rankings[by].rank(self.id)
     
-    @property
+    @memoized
     def transactions(self):
-        transactions = []
-
-        for id, transaction in self.db.transactions.items():
+        return [self.db.transactions[id].to_dict() for id in reversed(self.db.ledger.transactions(self.id))]
 
-            if getattr(transaction, 'to') is self.id:
-                transactions.append(transaction.to_dict())
-                continue
-
-            if getattr(transaction, 'from') is self.id:
-                transactions.append(transaction.to_dict())
-                continue
-
-        transactions.reverse()
+    @property
+    def transaction_count(self):
+        return len(self.db.ledger.transactions(self.id))
 
-        return transactions
+    def transaction_page(self, before=None, after=None, limit=50):
+        return self.db.transaction_page(before, after, limit, user_id=self.id)
 
-    @property
+    @memoized
     def submissions(self):
-        submissions = []
-        for id, submission in self.db.submissions.items():
-            if submission.author_id == self.id:
-                submissions.append(submission)
-        submissions.reverse()
-        return submissions
+        # Newest first
+        return [self.db.submissions[id] for id in reversed(self.db.user_submissions.get(self.id, []))]
 
-    @property
+    @memoized
     def fish_catches(self):
-        fish_catches = []
-        for id, fish in self.db.fish_catches.items():
-            if fish.angler == self.id:
-                fish_catches.append(fish)
-
-        fish_catches.reverse()
-        return fish_catches
+        # Newest first
+        return [self.db.fish_catches[id] for id in reversed(self.db.user_fish_catches.get(self.id, []))]
 
     def fish_catches_species(self, species):
         # List of catches of a specific species
@@ -441,28 +843,24 @@ class User(Object):
     @property
     def fish_species(self):
         # List of unique fish species user has caught
-        species = []
-        for fish in self.fish_catches:
-            if not fish.species in species:
-                species.append(fish.species)
-        return species
+        return list(self.db.species_caught.get(self.id, {}))
 
     @property
     def fished_today(self):
         # Indicate the count of fish user has caught today
         eastern = pytz.timezone('US/Eastern')
+        today = datetime.datetime.today().astimezone(eastern).date()
         fish_caught_today = 0
 
-        # No catch history means user has never fished before
-        if len(self.fish_catches) == 0:
-            return fish_caught_today
-
-        for fish in self.fish_catches:
+        # Newest first, so stop at the first catch from before today
+        for id in reversed(self.db.user_fish_catches.get(self.id, [])):
+            fish = self.db.fish_catches[id]
             fish_caught_ts = datetime.datetime.fromisoformat(fish.timestamp).replace(tzinfo=datetime.UTC).astimezone(eastern)
 
             # "Yesterday" is ditermined by the calendar day.
-            if not fish_caught_ts.date() < datetime.datetime.today().astimezone(eastern).date():
-                fish_caught_today += 1
+            if fish_caught_ts.date() < today:
+                break
+            fish_caught_today += 1
         
         return fish_caught_today
 
@@ -510,7 +908,9 @@ class User(Object):
         }
         return d
 
-class Token(Object):
+class Token(Record):
+    fields = ('id', 'created_at', 'note', 'link', 'disabled', 'hash')
+    __slots__ = fields
 
     next_hash_check = None
 
@@ -535,47 +935,26 @@ class Token(Object):
         #         self.disabled = True
         #         return '/static/blank.jpg'
 
-    @property
+    @memoized
     def owner(self):
-        owner = self.db.users[0]
-        for id, transaction in self.db.transactions.items():
-
-            if transaction.amount:
-                continue
-
-            if transaction.token is self.id:
-                owner = self.db.users[transaction.to]
-
-        return owner
+        return self.db.users[self.db.ledger.owner(self.id)]
     
-    @property
+    @memoized
     def transactions(self):
-        t = []
-        for id, transaction in self.db.transactions.items():
-            if transaction.token is self.id:
-                t.append(transaction)
-        t.reverse()
-        return t
+        return [self.db.transactions[id] for id in self.db.ledger.history(self.id)]
 
     @property
     def for_sale(self):
-        if self.id in self.db.for_sale():
-            return True
-        else:
-            return False
+        return self.id in self.db.active_listings
 
     @property
     def listing(self):
-        if self.for_sale:
-            return self.db.for_sale()[self.id]
-        else:
-            return None
+        return self.db.active_listings.get(self.id)
 
-    @property
+    @memoized
     def submission(self):
-        for id, sub in self.db.submissions.items():
-            if sub.token_id == self.id:
-                return sub
+        id = self.db.token_submissions.get(self.id)
+        return self.db.submissions[id] if id is not None else None
 
     def to_dict(self):
         d = {
@@ -587,13 +966,15 @@ class Token(Object):
         }
         return d
 
-class Transaction(Object):
+class Transaction(Record):
+    fields = ('id', 'timestamp', 'from', 'to', 'amount', 'token')
+    __slots__ = fields
 
-    @property
+    @memoized
     def user_from(self):
         return self.db.users[getattr(self, 'from')]
 
-    @property
+    @memoized
     def user_to(self):
         return self.db.users[getattr(self, 'to')]
 
@@ -619,12 +1000,9 @@ class Transaction(Object):
 
         return d
 
-class Achievement:
-    def __init__(self, name, icon):
-        self.name = name
-        self.icon = icon
-
-class Listing(Object):
+class Listing(Record):
+    fields = ('id', 'timestamp', 'seller_id', 'token_id', 'amount')
+    __slots__ = fields
 
     @property
     def seller(self):
@@ -634,7 +1012,9 @@ class Listing(Object):
     def token(self):
         return self.db.tokens[getattr(self, 'token_id')]
 
-class Submission(Object):
+class Submission(Record):
+    fields = ('id', 'created_at', 'author_id', 'token_id', 'reviewed')
+    __slots__ = fields
 
     @property
     def author(self):
@@ -644,14 +1024,10 @@ class Submission(Object):
     def token(self):
         return self.db.tokens[self.token_id]
 
-class Session:
-    def __init__(self, username):
-        self.username = username
-        self.expires = datetime.datetime.now() + datetime.timedelta(days=30)
-        self.token = str(uuid.uuid4())
-
-class FishCatches(Object):
-    pass
+class FishCatches(Record):
+    fields = ('id', 'timestamp', 'species', 'weight_lbs', 'length_in', 'angler', 'location_id')
+    interned = ('species', 'location_id')
+    __slots__ = fields
 
 def hash_img(url):
     # Take a PIL image and compute a "hash" representing the state of the image.
@@ -0,0 +1,142 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+class Ledger:
+    # Running projections of the transactions table.
+    #
+    # Every transaction is applied once, in order, as it is loaded or
+    # written. Balances, token owners and token histories are then lookups
+    # instead of scans over the whole ledger.
+
+    def __init__(self, transactions=()):
+        self.ids = []                               # every transaction id, ascending
+        self.user_transactions = defaultdict(list)  # user id -> ids of their transactions, ascending
+        self.balances = defaultdict(int)            # user id -> LBC balance
+        self.owners = {}                            # token id -> user id
+        self.holdings = defaultdict(dict)           # user id -> {token id: None}, in the order received
+        self.token_transactions = defaultdict(list) # token id -> ids of its transactions, ascending
+
+        for transaction in transactions:
+            self.apply(transaction)
+
+    def apply(self, transaction):
+        user_from = getattr(transaction, 'from')
+        user_to = getattr(transaction, 'to')
+        self.ids.append(transaction.id)
+        self.user_transactions[user_from].append(transaction.id)
+        if user_to != user_from:
+            self.user_transactions[user_to].append(transaction.id)
+
+        if transaction.amount:
+            self.balances[user_to] += transaction.amount
+            # The system account mints LBC by sending to itself
+            if not (user_from == user_to == 0):
+                self.balances[user_from] -= transaction.amount
+
+        if transaction.token:
+            self.token_transactions[transaction.token].append(transaction.id)
+
+            # Receiving a token you already hold keeps its original place
+            self.holdings[user_to].setdefault(transaction.token)
+            if user_from != user_to:
+                self.holdings[user_from].pop(transaction.token, None)
+
+            if not transaction.amount:
+                self.owners[transaction.token] = user_to
+
+    def balance(self, user_id):
+        return self.balances.get(user_id, 0)
+
+    def owner(self, token_id):
+        # Tokens that were never transferred belong to the system account
+        return self.owners.get(token_id, 0)
+
+    def tokens(self, user_id, start=0, stop=None):
+        # Token ids held by a user, most recently received first. The
+        # holdings are copied in one step first: transfers on other threads
+        # change them in place, and walking a dict while it changes raises.
+        return list(self.holdings.get(user_id, {}))[::-1][start:stop]
+
+    def token_count(self, user_id):
+        return len(self.holdings.get(user_id, {}))
+
+    def transactions(self, user_id):
+        # Ids of a user's transactions, sent or received, ascending
+        return self.user_transactions.get(user_id, [])
+
+    def history(self, token_id):
+        # Ids of a token's transactions, newest first
+        return list(reversed(self.token_transactions.get(token_id, [])))
+
+    def verify(self, transactions):
+        # Rebuild every projection from the raw ledger and compare.
+        # Returns a list of differences, empty when the projections are sound.
+        rebuilt = Ledger(transactions)
+        errors = []
+
+        if self.ids != rebuilt.ids:
+            errors.append(f'transaction ids: {len(self.ids)} != {len(rebuilt.ids)}')
+
+        for user_id in set(self.balances) | set(rebuilt.balances):
+            if self.balance(user_id) != rebuilt.balance(user_id):
+                errors.append(f'balance of user {user_id}: {self.balance(user_id)} != {rebuilt.balance(user_id)}')
+
+        for token_id in set(self.owners) | set(rebuilt.owners):
+            if self.owner(token_id) != rebuilt.owner(token_id):
+                errors.append(f'owner of token {token_id}: {self.owner(token_id)} != {rebuilt.owner(token_id)}')
+
+        for user_id in set(self.holdings) | set(rebuilt.holdings):
+            if self.tokens(user_id) != rebuilt.tokens(user_id):
+                errors.append(f'tokens of user {user_id}: {self.tokens(user_id)} != {rebuilt.tokens(user_id)}')
+
+        for user_id in set(self.user_transactions) | set(rebuilt.user_transactions):
+            if self.transactions(user_id) != rebuilt.transactions(user_id):
+                errors.append(f'transactions of user {user_id}: {len(self.transactions(user_id))} != {len(rebuilt.transactions(user_id))}')
+
+        for token_id in set(self.token_transactions) | set(rebuilt.token_transactions):
+            ids = self.history(token_id)
+            rebuilt_ids = rebuilt.history(token_id)
+            if ids != rebuilt_ids:
+                errors.append(f'history of token {token_id}: {ids} != {rebuilt_ids}')
+
+        return errors
+
+    def verify_columns(self, columns):
+        # Vectorized check of balances and owners against a TransactionColumns
+        # recount of the raw ledger (see columns.py). Much faster than verify()
+        # on large ledgers, but doesn't check holdings or token histories.
+        errors = []
+
+        balances = columns.balances()
+        for user_id in set(range(len(balances))) | set(self.balances):
+            expected = int(balances[user_id]) if user_id < len(balances) else 0
+            if self.balance(user_id) != expected:
+                errors.append(f'balance of user {user_id}: {self.balance(user_id)} != {expected}')
+
+        owners = columns.owners()
+        for token_id in set(self.owners) | set(owners):
+            if self.owner(token_id) != owners.get(token_id, 0):
+                errors.append(f'owner of token {token_id}: {self.owner(token_id)} != {owners.get(token_id, 0)}')
+
+        return errors
+
+def paginate(ids, before=None, after=None, limit=50):
+    # One newest-first page of an ascending list of ids, found by bisecting
+    # on the cursor so it costs the same wherever it is in the list.
+    #
+    #   before  ids older than this one (the next page)
+    #   after   ids newer than this one (the previous page)
+    #
+    # Returns (page ids newest first, cursor for newer ids, cursor for older
+    # ids). A cursor is None when there is nothing in that direction.
+    if after is not None:
+        start = bisect_right(ids, after)
+        end = min(start + limit, len(ids))
+    else:
+        end = len(ids) if before is None else bisect_left(ids, before)
+        start = max(end - limit, 0)
+
+    page = ids[start:end][::-1]
+    newer = page[0] if page and end < len(ids) else None
+    older = page[-1] if page and start > 0 else None
+    return page, newer, older
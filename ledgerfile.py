@@ -0,0 +1,309 @@
+import os
+import mmap
+import struct
+import datetime
+from bisect import bisect_left
+from collections.abc import MutableMapping
+
+# Fixed-width binary log of one table, memory-mapped for reads.
+#
+#   <db>.<table>.bin    16 byte header (magic, record size), then one
+#                       fixed-width record per row, in id order
+#   <db>.<table>.heap   the UTF-8 bytes of the table's string columns.
+#                       Records hold an (offset, length) pair into it.
+#
+# Record i lives at HEADER.size + i * record size, so reading any row is a
+# struct.unpack_from on the mapping: no parsing and no copy of the file.
+
+MAGIC = b'LBCLOG01'
+HEADER = struct.Struct('<8sq')
+
+# Stands in for None in integer columns
+NULL = -2**63
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Column kinds
+#   'int'   int64, may be None
+#   'float' float64
+#   'time'  ISO timestamp string, stored as int64 microseconds since the epoch
+#   'str'   string on the heap
+CODES = {'int': 'q', 'float': 'd', 'time': 'q', 'str': 'II'}
+
+LAYOUTS = {
+    'transactions': (
+        ('id', 'int'),
+        ('timestamp', 'time'),
+        ('from', 'int'),
+        ('to', 'int'),
+        ('amount', 'int'),
+        ('token', 'int'),
+    ),
+    'fish_catches': (
+        ('id', 'int'),
+        ('timestamp', 'time'),
+        ('species', 'str'),
+        ('weight_lbs', 'float'),
+        ('length_in', 'float'),
+        ('angler', 'int'),
+        ('location_id', 'str'),
+    ),
+}
+
+class Heap:
+    # Append-only string storage for the string columns of a record file.
+    # Each distinct string is stored once; the record file tells the heap
+    # what it already holds when it opens (see learn()).
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.offsets = {}   # String -> (offset, length) of its copy in the heap
+        self.map = None
+
+    def put(self, value):
+        if value in self.offsets:
+            return self.offsets[value]
+        data = value.encode('utf-8')
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        self.offsets[value] = (offset, len(data))
+        return self.offsets[value]
+
+    def learn(self, refs):
+        # Index strings already in the heap, given (offset, length) pairs
+        # the records point at, so put() reuses them instead of writing
+        # them again
+        for offset, length in refs:
+            self.offsets.setdefault(self.get(offset, length), (offset, length))
+
+    def get(self, offset, length):
+        # An empty string takes no bytes, and may be all an empty heap holds
+        if not length:
+            return ''
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+            if self.map is None or offset + length > len(self.map):
+                raise ValueError(f'{self.path} ends before the string at {offset}')
+        return self.map[offset:offset+length].decode('utf-8')
+
+    def remap(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.file.close()
+
+class RecordFile:
+
+    def __init__(self, path, layout, heap):
+        self.path = path
+        self.layout = layout
+        self.heap = heap
+        self.struct = struct.Struct('<' + ''.join(CODES[kind] for name, kind in layout))
+
+        # Where each string column's (offset, length) sits in a packed record
+        self.string_slots = []
+        n = 0
+        for name, kind in layout:
+            if kind == 'str':
+                self.string_slots.append(n)
+            n += len(CODES[kind])
+
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, self.struct.size))
+
+        with open(path, 'rb') as f:
+            magic, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != self.struct.size:
+            raise ValueError(f'{path} is not a record file of this layout')
+
+        # Drop a torn record left by a crash mid-append
+        self.count = (os.path.getsize(path) - HEADER.size) // self.struct.size
+        os.truncate(path, HEADER.size + self.count * self.struct.size)
+
+        self.file = open(path, 'ab')
+        self.map = None
+        if self.count and self.string_slots:
+            self.heap.learn(self.string_refs())
+
+    def __len__(self):
+        return self.count
+
+    def string_refs(self):
+        # The distinct (offset, length) pairs the records' strings point at
+        self.remap()
+        refs = set()
+        for packed in self.struct.iter_unpack(self.map[HEADER.size:HEADER.size + self.count * self.struct.size]):
+            for n in self.string_slots:
+                refs.add((packed[n], packed[n+1]))
+        return refs
+
+    def remap(self):
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def append(self, values):
+        packed = []
+        for (name, kind), value in zip(self.layout, values):
+            match kind:
+                case 'int':
+                    packed.append(NULL if value is None else value)
+                case 'float':
+                    packed.append(value)
+                case 'time':
+                    packed.append((datetime.datetime.fromisoformat(value) - EPOCH) // datetime.timedelta(microseconds=1))
+                case 'str':
+                    packed.extend(self.heap.put(value))
+        self.file.write(self.struct.pack(*packed))
+        self.file.flush()
+        self.count += 1
+
+    def raw(self, i):
+        # Record i as the packed tuple, straight off the mapping
+        end = HEADER.size + (i+1) * self.struct.size
+        if self.map is None or end > len(self.map):
+            self.remap()
+        return self.struct.unpack_from(self.map, HEADER.size + i * self.struct.size)
+
+    def read(self, i):
+        # Record i as a row of values in layout order
+        packed = iter(self.raw(i))
+        values = []
+        for name, kind in self.layout:
+            value = next(packed)
+            match kind:
+                case 'int':
+                    values.append(None if value == NULL else value)
+                case 'float':
+                    values.append(value)
+                case 'time':
+                    values.append((EPOCH + datetime.timedelta(microseconds=value)).isoformat())
+                case 'str':
+                    values.append(self.heap.get(value, next(packed)))
+        return tuple(values)
+
+    def id(self, i):
+        # The id column is first in every layout
+        return self.raw(i)[0]
+
+    def find(self, id):
+        # Index of the record with this id, or None. Ids are appended in
+        # increasing order and are usually contiguous, so try the obvious
+        # slot first and binary search otherwise.
+        if not self.count:
+            return None
+        guess = id - self.id(0)
+        if 0 <= guess < self.count and self.id(guess) == id:
+            return guess
+        i = bisect_left(range(self.count), id, key=self.id)
+        if i < self.count and self.id(i) == id:
+            return i
+        return None
+
+    def truncate(self, count):
+        if count < self.count:
+            self.map = None
+            self.file.truncate(HEADER.size + count * self.struct.size)
+            self.count = count
+
+    def close(self):
+        self.file.close()
+
+class MappedTable(MutableMapping):
+    # A table (id -> record) served from a RecordFile instead of memory.
+    #
+    # Records are built on access and not kept, so two lookups of the same
+    # id return equal but distinct objects. New records can only be added
+    # with an id larger than every existing one.
+
+    def __init__(self, path, worksheet, pattern, db):
+        self.path = path
+        self.worksheet = worksheet
+        self.pattern = pattern
+        self.db = db
+        self.open()
+
+    def open(self):
+        self.heap = Heap(f'{self.path}.{self.worksheet}.heap')
+        self.file = RecordFile(f'{self.path}.{self.worksheet}.bin', LAYOUTS[self.worksheet], self.heap)
+        self.headers = tuple(name for name, kind in LAYOUTS[self.worksheet])
+
+    def __getstate__(self):
+        # Pickled into snapshots by location only; the rows stay in the file
+        return {'path': self.path, 'worksheet': self.worksheet, 'pattern': self.pattern, 'count': len(self.file)}
+
+    def __setstate__(self, state):
+        count = state.pop('count')
+        self.__dict__.update(state)
+        self.db = None
+        self.open()
+        # Rows appended after the snapshot was taken are dropped here and
+        # come back when the journal is replayed on top of the snapshot
+        if len(self.file) < count:
+            raise ValueError(f'{self.file.path} is shorter than its snapshot')
+        self.file.truncate(count)
+
+    def record(self, i):
+        return self.pattern.from_row(self.headers, self.file.read(i), self.db)
+
+    def __len__(self):
+        return len(self.file)
+
+    def __getitem__(self, id):
+        i = self.file.find(id)
+        if i is None:
+            raise KeyError(id)
+        return self.record(i)
+
+    def __contains__(self, id):
+        return self.file.find(id) is not None
+
+    def __iter__(self):
+        for i in range(len(self.file)):
+            yield self.file.id(i)
+
+    def __reversed__(self):
+        for i in reversed(range(len(self.file))):
+            yield self.file.id(i)
+
+    def __setitem__(self, id, obj):
+        if len(self.file) and id <= self.file.id(len(self.file)-1):
+            raise KeyError(f'{self.worksheet} {id} is not newer than the last record')
+        self.file.append([getattr(obj, name) for name in self.headers])
+
+    def __delitem__(self, id):
+        raise TypeError('Records cannot be removed from a mapped table')
+
+    def values(self):
+        for i in range(len(self.file)):
+            yield self.record(i)
+
+    def items(self):
+        for obj in self.values():
+            yield obj.id, obj
+
+    def page(self, start, stop):
+        # Records start..stop-1 by position, read straight from the file
+        return [self.record(i) for i in range(max(start, 0), min(stop, len(self.file)))]
+
+    def last_id(self):
+        return self.file.id(len(self.file)-1) if len(self.file) else None
+
+def map_table(path, worksheet, pattern, db, table):
+    # Put a loaded table in its record file and return the mapped table.
+    # The file is rebuilt whenever it doesn't hold exactly the loaded rows.
+    mapped = MappedTable(path, worksheet, pattern, db)
+    last_id = next(reversed(table), None)
+    if len(mapped) != len(table) or mapped.last_id() != last_id:
+        mapped.file.close()
+        mapped.heap.close()
+        for suffix in ('bin', 'heap'):
+            os.remove(f'{path}.{worksheet}.{suffix}')
+        mapped = MappedTable(path, worksheet, pattern, db)
+        for id, obj in table.items():
+            mapped[id] = obj
+    return mapped
@@ -0,0 +1,45 @@
+import os
+import sys
+
+from storage import WorkbookStorage, SqliteStorage
+
+# Import an existing db.xlsx (plus any journal not yet checkpointed)
+# into a new SQLite database.
+#
+#   python migrate.py db.xlsx db.sqlite
+#
+# Then point the app at it with LBC_DB=db.sqlite.
+
+BATCH_SIZE = 1000
+
+def migrate(xlsx_path, sqlite_path):
+    if os.path.exists(sqlite_path):
+        raise SystemExit(f'{sqlite_path} already exists')
+
+    source = WorkbookStorage(xlsx_path)
+    target = SqliteStorage(sqlite_path)
+
+    for sheet, table in target.tables.items():
+        rows = source.rows(sheet)
+        headers = next(rows)
+        fields = [table._meta.columns[h] for h in headers]
+
+        count = 0
+        with target.database.atomic():
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == BATCH_SIZE:
+                    table.insert_many(batch, fields=fields).execute()
+                    count += len(batch)
+                    batch = []
+            if batch:
+                table.insert_many(batch, fields=fields).execute()
+                count += len(batch)
+
+        print(f'{sheet}: {count} rows')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        raise SystemExit('usage: python migrate.py db.xlsx db.sqlite')
+    migrate(sys.argv[1], sys.argv[2])
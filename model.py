@@ -51,24 +51,125 @@ class Experience(Base):
     skill = ForeignKeyField(Skill)
     experience = IntegerField()
 
+# Lute Bear Coin ledger
+#
+# These tables mirror the sheets of db.xlsx column for column so the
+# Database in db.py can run on either. See SqliteStorage in storage.py.
+
+class User(Base):
+    '''
+    User
+
+    id              Number      User record ID. The system account is 0
+    username        String      User login name
+    password        String      User password hash
+    nickname        String      Display name
+    created_at      String      ISO timestamp when the account was created
+    admin           Boolean     Controls if user has admin permissions
+    '''
+    id = IntegerField(primary_key=True)
+    username = CharField(unique=True)
+    password = CharField()
+    nickname = CharField()
+    created_at = CharField()
+    admin = BooleanField(default=False)
+
+    class Meta:
+        table_name = 'users'
+
 class Token(Base):
-    created_at = DateTimeField(default=datetime.datetime.now())
-    title = CharField()
+    '''
+    Token
+
+    id              Number      Token record ID
+    created_at      String      ISO timestamp when the token was submitted
+    note            String      Token title
+    link            String      Image url
+    disabled        Boolean     Hidden until the submission is approved
+    hash            String      Image hash, see db.hash_img
+    '''
+    id = IntegerField(primary_key=True)
+    created_at = CharField()
+    note = CharField()
     link = CharField()
-    hidden = BooleanField(default=False)
+    disabled = BooleanField(default=True)
+    hash = CharField(null=True)
 
-class Transactions(Base):
+    class Meta:
+        table_name = 'tokens'
+
+class Transaction(Base):
     '''
     Transaction
 
-    Represents one transaction.
+    Represents one transfer of LBC (amount) or of a token from one user to another.
     '''
-    created_at = DateTimeField(default=datetime.datetime.now())
-    from_player_id = ForeignKeyField(Player)
-    to_player_id = ForeignKeyField(Player)
-    amount = IntegerField()
-    token = ForeignKeyField(Token)
+    id = IntegerField(primary_key=True)
+    timestamp = CharField()
+    from_id = IntegerField(column_name='from', index=True)
+    to_id = IntegerField(column_name='to', index=True)
+    amount = IntegerField(null=True)
+    token = IntegerField(null=True, index=True)
+
+    class Meta:
+        table_name = 'transactions'
+
+class Listing(Base):
+    '''
+    Listing
+
+    A token put up for sale. A listing with no amount takes the token off the market.
+    '''
+    id = IntegerField(primary_key=True)
+    timestamp = CharField()
+    seller_id = IntegerField()
+    token_id = IntegerField(index=True)
+    amount = IntegerField(null=True)
+
+    class Meta:
+        table_name = 'listings'
+
+class FishCatch(Base):
+    '''
+    FishCatch
 
+    One fish caught by an angler at a fishing location.
+    '''
+    id = IntegerField(primary_key=True)
+    timestamp = CharField()
+    species = CharField()
+    weight_lbs = FloatField()
+    length_in = FloatField()
+    angler = IntegerField(index=True)
+    location_id = CharField(index=True)
+
+    class Meta:
+        table_name = 'fish_catches'
+
+class Submission(Base):
+    '''
+    Submission
+
+    A token waiting for (or done with) admin review.
+    '''
+    id = IntegerField(primary_key=True)
+    created_at = CharField()
+    author_id = IntegerField(index=True)
+    token_id = IntegerField()
+    reviewed = BooleanField(default=False)
+
+    class Meta:
+        table_name = 'submissions'
+
+# Worksheet name -> table
+TABLES = {
+    'users': User,
+    'tokens': Token,
+    'transactions': Transaction,
+    'listings': Listing,
+    'fish_catches': FishCatch,
+    'submissions': Submission,
+}
 
 if __name__ == '__main__':
 
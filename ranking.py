@@ -0,0 +1,90 @@
+from bisect import bisect_left, insort
+
+class Ranking:
+    # Users ordered by a score, highest first, kept sorted as scores change.
+    #
+    # Entries are (-score, user id) in an ascending list, so ties go to the
+    # lower user id. Finding a user's place is a binary search; moving it is
+    # one list shift, which for the number of users we have is far cheaper
+    # than re-sorting on every read.
+
+    def __init__(self):
+        self.scores = {}    # user id -> score
+        self.entries = []   # (-score, user id), ascending
+
+    def __len__(self):
+        return len(self.entries)
+
+    def score(self, user_id):
+        return self.scores.get(user_id, 0)
+
+    def set(self, user_id, score):
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            del self.entries[bisect_left(self.entries, (-old, user_id))]
+        self.scores[user_id] = score
+        insort(self.entries, (-score, user_id))
+
+    def add(self, user_id, amount):
+        self.set(user_id, self.score(user_id) + amount)
+
+    def rank(self, user_id):
+        # 1 for the highest score, None for users not ranked
+        if user_id not in self.scores:
+            return None
+        return bisect_left(self.entries, (-self.scores[user_id], user_id)) + 1
+
+    def top(self, n, start=0):
+        # (user id, score) for ranks start+1 to start+n
+        return [(user_id, -score) for score, user_id in self.entries[start:start+n]]
+
+    def ranked(self):
+        # How many users have a score above zero; they come first
+        return bisect_left(self.entries, (0, -1))
+
+class TopK:
+    # The k highest scores seen so far, highest first, with ties going to
+    # the lower id. Adding a score is a binary search into at most k
+    # entries; anything below the k-th is dropped straight away.
+
+    def __init__(self, k):
+        self.k = k
+        self.entries = []   # (-score, id), ascending
+
+    def add(self, id, score):
+        entry = (-score, id)
+        if len(self.entries) == self.k and entry >= self.entries[-1]:
+            return
+        insort(self.entries, entry)
+        del self.entries[self.k:]
+
+    def ids(self):
+        return [id for score, id in self.entries]
+
+class CatchRecords:
+    # Record catches: the k longest and k heaviest per fishing location and
+    # per species, and the number of catches per location. Fed every catch
+    # in order by Database.index().
+
+    measures = {'length': 'length_in', 'weight': 'weight_lbs'}
+
+    def __init__(self, k=10):
+        self.k = k
+        self.counts = {}    # location id -> catches there
+        self.boards = {}    # (measure, 'location' or 'species', id) -> TopK of catch ids
+
+    def add(self, catch):
+        self.counts[catch.location_id] = self.counts.get(catch.location_id, 0) + 1
+        for measure, field in self.measures.items():
+            for key in (('location', catch.location_id), ('species', catch.species)):
+                board = self.boards.get((measure,) + key)
+                if board is None:
+                    board = self.boards[(measure,) + key] = TopK(self.k)
+                board.add(catch.id, getattr(catch, field))
+
+    def top(self, measure, kind, id):
+        # Catch ids, best first
+        board = self.boards.get((measure, kind, id))
+        return board.ids() if board else []
@@ -0,0 +1,100 @@
+import time
+import uuid
+import sqlite3
+import datetime
+import threading
+
+# Login sessions, kept in a small SQLite file next to the database so they
+# survive restarts and are shared by every worker process using it.
+#
+# Lookups are by session token. Each process keeps recently checked
+# sessions in memory for CACHE_SECONDS, so a logout in another process can
+# take up to that long to be seen here. Logouts in this process are seen
+# at once.
+
+LIFETIME = datetime.timedelta(days=30)
+CACHE_SECONDS = 5
+CACHE_SIZE = 10000
+SWEEP_SECONDS = 3600
+
+class Session:
+    def __init__(self, username, token=None, expires=None):
+        self.username = username
+        self.expires = expires or datetime.datetime.now() + LIFETIME
+        self.token = token or str(uuid.uuid4())
+
+    def expired(self):
+        return self.expires <= datetime.datetime.now()
+
+class SessionStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires REAL NOT NULL
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username)')
+        self.lock = threading.Lock()
+        self.cache = {}     # token -> (Session, time it was read)
+        self.swept = None   # time.monotonic() of the last sweep
+
+    def start(self, username):
+        # One session per user. Logging in again replaces the old one.
+        session = Session(username)
+        with self.lock:
+            self.sweep()
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM sessions WHERE username = ?', (username,))
+            self.connection.execute(
+                'INSERT INTO sessions VALUES (?, ?, ?)',
+                (session.token, username, session.expires.timestamp())
+            )
+            self.connection.execute('COMMIT')
+            self.forget(username)
+        return session
+
+    def end(self, username):
+        with self.lock:
+            self.connection.execute('DELETE FROM sessions WHERE username = ?', (username,))
+            self.forget(username)
+
+    def get(self, token):
+        # The live session with this token, or None
+        if not token:
+            return None
+        now = time.monotonic()
+        cached = self.cache.get(token)
+        if cached and now - cached[1] < CACHE_SECONDS:
+            session = cached[0]
+        else:
+            with self.lock:
+                row = self.connection.execute(
+                    'SELECT username, expires FROM sessions WHERE token = ?', (token,)
+                ).fetchone()
+                session = row and Session(row[0], token, datetime.datetime.fromtimestamp(row[1]))
+                if len(self.cache) >= CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[token] = (session, now)
+
+        if session and session.expired():
+            return None
+        return session
+
+    def forget(self, username):
+        # Drop a user's sessions from the cache. Called with the lock held.
+        for token, (session, read) in list(self.cache.items()):
+            if session and session.username == username:
+                del self.cache[token]
+
+    def sweep(self):
+        # Delete expired sessions, at most once per SWEEP_SECONDS. Called
+        # with the lock held.
+        if self.swept is not None and time.monotonic() - self.swept < SWEEP_SECONDS:
+            return
+        self.connection.execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),))
+        self.swept = time.monotonic()
@@ -0,0 +1,138 @@
+import sys
+import math
+import random
+import argparse
+import numpy as np
+
+from activities.fishing import FISHING
+
+# Offline model of the fishing economy, for trying out changes to
+# value_lbc or drop weights in activities/fishing.py before they go live.
+#
+#   python simulate.py [--anglers 10000] [--days 365] [--seed 0] [--samples 100000]
+#                      [--route tour|best|<location id> ...]
+#
+# Every simulated angler fishes every day and uses their full daily
+# allowance (fishing_attempts_allowed catches, at any locations). Where they
+# fish is the route:
+#   tour    one catch at each location
+#   best    every catch at the location worth the most LBC per catch, the
+#           most an angler can mint
+#   <id>    every catch at that location
+# By default both tour and best are reported. For each route:
+#   - LBC minted by the system account per angler-day and per angler-week,
+#     and per day across all anglers
+#   - days until an angler has caught every species (the collection log),
+#     over the anglers who finished within --days only, so biased low
+# Then, once, a chi-square check that get_drop(), the draw the app uses,
+# matches each location's configured weights.
+
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+
+def expected_value(location):
+    # Mean LBC paid for one catch at a location
+    table = location.drop_table
+    return float((table.value_lbc * np.array(table.weights)).sum() / sum(table.weights))
+
+def route(name, fishing=FISHING):
+    # The locations of one day's catches, one entry per catch
+    match name:
+        case 'tour':
+            return list(fishing.locations)
+        case 'best':
+            return [max(fishing.locations, key=expected_value)] * fishing.fishing_attempts_allowed
+    location = fishing.location(name)
+    if not location:
+        raise SystemExit(f'Unknown route {name!r}')
+    return [location] * fishing.fishing_attempts_allowed
+
+def simulate(anglers, days, rng, locations, fishing=FISHING):
+    # Anglers fishing `locations` every day. Returns (LBC minted per day
+    # and angler, day each angler completed the collection log or -1),
+    # each as arrays.
+    species_ids = list(fishing.species)
+    minted = np.zeros((days, anglers), dtype=np.int64)
+    first_caught = np.full((len(species_ids), anglers), -1)
+
+    for location in dict.fromkeys(locations):
+        table = location.drop_table
+        catches = locations.count(location)
+        species = table.get_species(catches * days * anglers, rng).reshape(catches, days, anglers)
+        minted += table.value_lbc[species].sum(axis=0)
+
+        for i, drop in enumerate(table.drops):
+            caught = (species == i).any(axis=0)
+            ever = caught.any(axis=0)
+            first_caught[species_ids.index(drop.id)] = np.where(ever, caught.argmax(axis=0), -1)
+
+    completed = np.where((first_caught >= 0).all(axis=0), first_caught.max(axis=0) + 1, -1)
+    return minted, completed
+
+def audit(samples, fishing=FISHING):
+    # (location, chi-square statistic, degrees of freedom, p-value) for
+    # `samples` draws of get_drop() at each location
+    results = []
+    for location in fishing.locations:
+        table = location.drop_table
+        index = {drop.id: i for i, drop in enumerate(table.drops)}
+        observed = np.zeros(len(table.drops))
+        for _ in range(samples):
+            observed[index[table.get_drop().species.id]] += 1
+        expected = samples * np.array(table.weights) / sum(table.weights)
+        statistic = float(((observed - expected) ** 2 / expected).sum())
+        df = len(table.drops) - 1
+        results.append((location, statistic, df, chi2_sf(statistic, df)))
+    return results
+
+def chi2_sf(x, df):
+    # P(X >= x) for a chi-square distribution, by the Wilson-Hilferty
+    # normal approximation (good to a few parts in a thousand for df >= 3)
+    z = ((x / df) ** (1/3) - (1 - 2 / (9*df))) / math.sqrt(2 / (9*df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def describe(name, values):
+    percentiles = ' '.join(f'p{p}={v:g}' for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    print(f'{name:<28} mean={values.mean():.2f} sd={values.std():.2f} {percentiles}')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Simulate the LBC fishing economy')
+    parser.add_argument('--anglers', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--samples', type=int, default=100000, help='get_drop() draws per location for the audit')
+    parser.add_argument('--route', action='append', help='tour, best or a location id; may be repeated')
+    options = parser.parse_args(argv)
+
+    rng = np.random.default_rng(options.seed)
+    random.seed(options.seed)
+    weeks = options.days // 7
+
+    print(f'{options.anglers} anglers, {options.days} days, {FISHING.fishing_attempts_allowed} catches a day at any locations')
+    for location in FISHING.locations:
+        print(f'  {location.name:<26} {expected_value(location):.2f} LBC per catch')
+
+    for name in options.route or ['tour', 'best']:
+        locations = route(name)
+        minted, completed = simulate(options.anglers, options.days, rng, locations)
+
+        print(f'\nRoute {name}: ' + ', '.join(location.name for location in locations))
+        describe('LBC per angler-day', minted.ravel())
+        if weeks:
+            describe('LBC per angler-week', minted[:weeks*7].reshape(weeks, 7, -1).sum(axis=1).ravel())
+        describe('LBC per day, all anglers', minted.sum(axis=1))
+
+        done = completed[completed >= 0]
+        print(f'Collection log ({len(FISHING.species)} species): completed by {len(done)} of {options.anglers} anglers')
+        if len(done):
+            # Anglers still short of a species at the end aren't counted
+            describe('days to complete, finishers', done)
+            if len(done) < options.anglers:
+                print(f'  (only anglers who finished within {options.days} days, so biased low)')
+
+    print(f'\nDrop rates, {options.samples} get_drop() draws per location')
+    for location, statistic, df, p in audit(options.samples):
+        flag = '' if p >= 0.001 else '  <- does not match its weights'
+        print(f'{location.name:<28} chi2={statistic:.2f} df={df} p={p:.3f}{flag}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,431 @@
+import os
+import json
+import time
+import threading
+import openpyxl
+from concurrent.futures import ProcessPoolExecutor
+
+# Workbooks smaller than this load faster without starting worker processes
+PARALLEL_LOAD_BYTES = 2_000_000
+
+def read_sheet(path, sheet):
+    # Stream one sheet of a workbook in read-only mode.
+    # Returns the header row and a list of value tuples, one per record.
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = workbook[sheet].iter_rows(values_only=True)
+        headers = next(rows)
+        width = len(headers)
+        data = []
+        for row in rows:
+            # Read-only mode can yield blank trailing rows and short rows
+            if not row or row[0] is None:
+                continue
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            data.append(row[:width])
+        return headers, data
+    finally:
+        workbook.close()
+
+class Journal:
+    # Append-only write-ahead log of changes made to the workbook.
+    # Each line is one JSON record:
+    #
+    #   {"op": "append", "sheet": "transactions", "row": [...]}
+    #   {"op": "update", "sheet": "users", "id": 3, "column": "password", "value": "..."}
+    #
+    # Records are replayed on top of the last checkpoint when the database opens.
+
+    def __init__(self, path):
+        self.path = path
+        self.recover()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def recover(self):
+        # A process that died mid-write leaves a torn final line. Cut it off
+        # so the next entry starts on a line of its own; everything before
+        # it made it to disk and is still good.
+        if not os.path.exists(self.path):
+            return
+        end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                end += len(line)
+        if end < os.path.getsize(self.path):
+            os.truncate(self.path, end)
+
+    def entries(self, offset=0):
+        # Entries from `offset` bytes into the journal onwards
+        self.file.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                # Only a line still being written can lack its newline
+                if not line.endswith(b'\n'):
+                    return
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    raise ValueError(f'{self.path} is corrupt at byte {offset}: {line[:80]!r}')
+                offset += len(line)
+
+    def position(self):
+        # Size of the journal in bytes, i.e. the offset of the next entry
+        self.file.flush()
+        return os.path.getsize(self.path)
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_out(self):
+        # Hand the buffered entries to the OS and return a function that
+        # waits until they are on disk. That part needs no lock: it syncs
+        # its own handle, so a checkpoint swapping the file meanwhile is fine.
+        self.file.flush()
+        fd = os.dup(self.file.fileno())
+        def sync():
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return sync
+
+    def truncate(self):
+        self.file.close()
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.flush()
+
+    def close(self):
+        self.file.close()
+
+class WorkbookStorage:
+    # Persists the database to an xlsx workbook.
+    #
+    # With journal=True every change is appended to `<path>.journal` and the
+    # workbook itself is only rewritten at checkpoints. The workbook is not
+    # even opened until something needs it (rows() or a checkpoint), so a
+    # Database started from a snapshot never parses it.
+    # With journal=False the whole workbook is saved after every change.
+
+    def __init__(self, path, journal=True):
+        self.path = path
+        self.loaded_workbook = None
+        self.row_numbers = {}
+        self.journal = None
+        self.pending = 0    # Changes not yet folded into the workbook
+
+        if journal:
+            self.journal = Journal(path + '.journal')
+            self.pending = sum(1 for _ in self.journal.entries())
+
+    @property
+    def workbook(self):
+        if self.loaded_workbook is None:
+            self.loaded_workbook = openpyxl.load_workbook(self.path)
+            if self.journal:
+                self.replay()
+        return self.loaded_workbook
+
+    def signature(self):
+        # Identifies this exact version of the workbook file
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def row_counts(self):
+        # Records in each sheet of the workbook file as saved, read from the
+        # sheets' dimensions without parsing any rows. None for a sheet
+        # saved without one.
+        workbook = openpyxl.load_workbook(self.path, read_only=True)
+        try:
+            return {ws.title: ws.max_row - 1 if ws.max_row else None for ws in workbook.worksheets}
+        finally:
+            workbook.close()
+
+    def replay(self):
+        for entry in self.journal.entries():
+            match entry['op']:
+                case 'append':
+                    # A crash between saving a checkpoint and truncating the
+                    # journal leaves rows in both. Skip rows already present.
+                    if entry['row'][0] in self.ids(entry['sheet']):
+                        continue
+                    self.apply_append(entry['sheet'], entry['row'])
+                case 'update':
+                    self.apply_update(entry['sheet'], entry['id'], entry['column'], entry['value'])
+
+    def ids(self, sheet):
+        # Map of record id -> row number in the worksheet
+        if sheet not in self.row_numbers:
+            rows = {}
+            for n, (id,) in enumerate(self.workbook[sheet].iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+                rows[id] = n
+            self.row_numbers[sheet] = rows
+        return self.row_numbers[sheet]
+
+    def headers(self, sheet):
+        return [c.value for c in self.workbook[sheet][1]]
+
+    def rows(self, sheet):
+        # Header row first, then one tuple of values per record
+        return self.workbook[sheet].iter_rows(values_only=True)
+
+    def load(self, sheets):
+        # Read every sheet for a full load: sheet -> (headers, rows).
+        # This streams the file as saved at the last checkpoint; the journal
+        # is not applied, the caller replays it on top.
+        workers = min(len(sheets), os.cpu_count() or 1)
+        if workers > 1 and os.path.getsize(self.path) >= PARALLEL_LOAD_BYTES:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = pool.map(read_sheet, [self.path]*len(sheets), sheets)
+                return dict(zip(sheets, results))
+        return {sheet: read_sheet(self.path, sheet) for sheet in sheets}
+
+    def apply_append(self, sheet, row):
+        worksheet = self.workbook[sheet]
+        worksheet.append(row)
+        if sheet in self.row_numbers:
+            self.row_numbers[sheet][row[0]] = worksheet.max_row
+
+    def apply_update(self, sheet, id, column, value):
+        worksheet = self.workbook[sheet]
+        worksheet.cell(
+            row=self.ids(sheet)[id],
+            column=self.headers(sheet).index(column)+1
+        ).value = value
+
+    def append(self, sheet, row):
+        if self.journal:
+            self.journal.write({'op': 'append', 'sheet': sheet, 'row': row})
+        # An unopened workbook catches up from the journal when it is opened
+        if self.loaded_workbook is not None or not self.journal:
+            self.apply_append(sheet, row)
+        self.pending += 1
+
+    def update(self, sheet, id, column, value):
+        if self.journal:
+            self.journal.write({'op': 'update', 'sheet': sheet, 'id': id, 'column': column, 'value': value})
+        if self.loaded_workbook is not None or not self.journal:
+            self.apply_update(sheet, id, column, value)
+        self.pending += 1
+
+    def commit(self):
+        # Write out every change since the last commit. Returns a function
+        # that waits until they are durable, or None when they already are.
+        if not self.journal:
+            self.checkpoint()
+            return None
+        return self.journal.write_out()
+
+    def checkpoint(self):
+        # Fold the journal into the workbook and start a new, empty journal
+        if self.journal:
+            self.journal.flush()
+        self.save()
+        if self.journal:
+            self.journal.truncate()
+            # Don't hold the writable workbook between checkpoints. The next
+            # one reopens it and catches up from the journal.
+            self.loaded_workbook = None
+            self.row_numbers = {}
+        self.pending = 0
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written workbook
+        tmp = self.path + '.tmp'
+        self.workbook.save(tmp)
+        os.replace(tmp, self.path)
+
+class SqliteStorage:
+    # Persists the database to SQLite using the tables in model.py.
+    # Every change is a row-level INSERT or UPDATE; commit() ends the
+    # SQLite transaction the changes were made in.
+    #
+    # There is no journal and nothing to checkpoint, and no snapshot is
+    # taken: loading straight from SQLite is already cheap.
+
+    journal = None
+    pending = 0
+
+    def __init__(self, path):
+        import model
+        self.path = path
+        self.tables = model.TABLES
+        # One connection shared by every thread. Database serializes writes,
+        # and group commit flushes from its own thread.
+        self.database = model.SqliteDatabase(
+            path,
+            pragmas={'journal_mode': 'wal'},
+            thread_safe=False,
+            check_same_thread=False
+        )
+        self.database.bind(list(self.tables.values()))
+        self.database.connect()
+        self.database.create_tables(list(self.tables.values()))
+        self.in_transaction = False
+
+    def signature(self):
+        # None turns snapshots off, see Database.load_snapshot()
+        return None
+
+    def fields(self, sheet):
+        return self.tables[sheet]._meta.sorted_fields
+
+    def rows(self, sheet):
+        table = self.tables[sheet]
+        yield tuple(f.column_name for f in self.fields(sheet))
+        yield from table.select().order_by(table.id).tuples().iterator()
+
+    def load(self, sheets):
+        # Read every table for a full load: sheet -> (headers, rows)
+        data = {}
+        for sheet in sheets:
+            rows = self.rows(sheet)
+            headers = next(rows)
+            data[sheet] = (headers, list(rows))
+        return data
+
+    def begin(self):
+        if not self.in_transaction:
+            self.database.begin()
+            self.in_transaction = True
+
+    def append(self, sheet, row):
+        self.begin()
+        self.tables[sheet].insert(dict(zip(self.fields(sheet), row))).execute()
+
+    def update(self, sheet, id, column, value):
+        self.begin()
+        table = self.tables[sheet]
+        table.update({table._meta.columns[column]: value}).where(table.id == id).execute()
+
+    def commit(self):
+        # SQLite syncs as part of the commit, and the connection is shared,
+        # so there is nothing left to wait for outside the lock
+        if self.in_transaction:
+            self.database.commit()
+            self.in_transaction = False
+        return None
+
+    def checkpoint(self):
+        self.commit()
+
+class GroupCommitter:
+    # Decides when a storage's commit() (its durable flush) actually runs.
+    #
+    #   'sync'   flush once per write, before the write returns
+    #   'group'  writes arriving within `window` seconds (or until `max_batch`
+    #            are waiting) share one flush. Each write still only returns
+    #            once it is durable.
+    #   'async'  return straight away and let a background thread flush.
+    #            A crash can lose the last `window` seconds of writes.
+    #
+    # `flush` runs with `lock` held so it never sees a half-applied write.
+    # It may return a function that waits for the disk; that runs after the
+    # lock is released, so other writers carry on in the meantime.
+
+    def __init__(self, flush, lock, mode='sync', window=0.005, max_batch=64):
+        if mode not in ('sync', 'group', 'async'):
+            raise ValueError(f'Unknown durability mode {mode!r}')
+        self.flush = flush
+        self.lock = lock
+        self.mode = mode
+        self.window = window
+        self.max_batch = max_batch
+
+        self.condition = threading.Condition()
+        self.requested = 0  # Commits asked for
+        self.durable = 0    # Commits flushed to disk
+        self.error = None
+
+        self.flushes = 0
+        self.batch_size_max = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+        if mode != 'sync':
+            threading.Thread(target=self.run, name='group-commit', daemon=True).start()
+
+    def commit(self):
+        if self.mode == 'sync':
+            with self.condition:
+                self.requested += 1
+                target = self.requested
+            self.flush_batch(target)
+            return
+
+        with self.condition:
+            self.requested += 1
+            target = self.requested
+            self.condition.notify_all()
+            if self.mode == 'async':
+                return
+            while self.durable < target and not self.error:
+                self.condition.wait()
+            if self.error:
+                raise self.error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.requested == self.durable:
+                    self.condition.wait()
+
+                # Give other writers a moment to join this batch
+                deadline = time.monotonic() + self.window
+                while self.requested - self.durable < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                target = self.requested
+
+            try:
+                self.flush_batch(target)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+    def flush_batch(self, target):
+        started = time.perf_counter()
+        with self.lock:
+            sync = self.flush()
+        if sync:
+            sync()
+        elapsed = time.perf_counter() - started
+
+        with self.condition:
+            batch_size = max(target - self.durable, 0)
+            self.durable = max(self.durable, target)
+            self.flushes += 1
+            self.batch_size_max = max(self.batch_size_max, batch_size)
+            self.flush_seconds_total += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'mode': self.mode,
+                'commits': self.requested,
+                'flushes': self.flushes,
+                'pending': self.requested - self.durable,
+                'batch_size_mean': self.durable / self.flushes if self.flushes else 0,
+                'batch_size_max': self.batch_size_max,
+                'flush_ms_mean': 1000 * self.flush_seconds_total / self.flushes if self.flushes else 0,
+                'flush_ms_max': 1000 * self.flush_seconds_max,
+            }
+
+def open_storage(path, journal=True):
+    # Pick the backend from the file extension
+    if path.endswith('.sqlite'):
+        return SqliteStorage(path)
+    return WorkbookStorage(path, journal=journal)